@@ -1 +1,9 @@
 VERSION = (0, 1, 0)
+
+
+def bulk():
+    """Shortcut for filch.queue.bulk, imported lazily so setup.py can
+    read VERSION without Django being configured.
+    """
+    from filch.queue import bulk
+    return bulk()
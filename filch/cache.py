@@ -0,0 +1,102 @@
+import hashlib
+from itertools import count
+
+from django.core.cache import cache as default_cache
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import signals
+from django.db.models.sql.datastructures import EmptyResultSet
+
+
+# Tells the receivers of every cache apart. id() can't be used, a new
+# cache can get the id of one that is gone but still connected.
+_uids = count()
+
+
+class ContentObjectCache(object):
+    """Caches the objects resolved by get_content_objects across
+    requests using the Django cache framework.
+
+    Each object is stored under a key for its database, model and pk
+    that holds the object as loaded by every queryset it was resolved
+    with. Saving or deleting an object drops that key. Changes to
+    objects it was loaded with through select_related don't, so set a
+    timeout when those matter.
+
+    Saves and deletes only drop keys of the models in models, given as
+    classes or "app_label.Model" strings. Without models the cache only
+    drops keys of models it has stored objects of itself, so a process
+    that changes the cached models without reading them has to pass
+    them. Pass '__all__' to drop keys for every model, which costs a
+    cache delete on every save.
+    """
+
+    def __init__(self, cache=None, timeout=None, prefix='filch',
+                 models=None):
+        self.cache = cache or default_cache
+        self.timeout = timeout
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        if models == '__all__':
+            self.labels = None
+        else:
+            self.labels = set([self.label(model) for model in models or ()])
+
+        # Listen from the start, the models may not be loaded yet.
+        uid = '%s.%s' % (self.prefix, next(_uids))
+        signals.post_save.connect(self.invalidate, dispatch_uid=uid)
+        signals.post_delete.connect(self.invalidate, dispatch_uid=uid)
+
+    def label(self, model):
+        if isinstance(model, basestring):
+            return model.lower()
+        return ('%s.%s' % (model._meta.app_label,
+                           model._meta.object_name)).lower()
+
+    def key(self, model, pk, using=DEFAULT_DB_ALIAS):
+        return '%s:%s:%s.%s:%s' % (self.prefix, using,
+            model._meta.app_label, model._meta.object_name, pk)
+
+    def queryset_key(self, queryset):
+        # Identifies how an object was loaded, so objects from a
+        # custom queryset aren't handed out for the default one.
+        try:
+            sql = str(queryset.query)
+        except EmptyResultSet:
+            sql = ''
+        return hashlib.md5(sql.encode('utf-8')).hexdigest()
+
+    def get_many(self, model, pks, queryset_key, using=DEFAULT_DB_ALIAS):
+        """Returns a dict of the cached objects of model with pks on
+        the database using that were loaded by the queryset with
+        queryset_key, along with the cache entries so set_many doesn't
+        have to read them again.
+        """
+        keys = dict((self.key(model, pk, using), pk) for pk in pks)
+        entries = self.cache.get_many(keys.keys())
+        objects = {}
+        for key, entry in entries.items():
+            if queryset_key in entry:
+                objects[keys[key]] = entry[queryset_key]
+        self.hits += len(objects)
+        self.misses += len(keys) - len(objects)
+        return objects, entries
+
+    def set_many(self, model, objects, queryset_key, entries=None,
+                 using=DEFAULT_DB_ALIAS):
+        if entries is None:
+            entries = {}
+        if self.labels is not None:
+            self.labels.add(self.label(model))
+        for obj in objects:
+            key = self.key(model, obj.pk, using)
+            entry = entries.get(key) or {}
+            entry[queryset_key] = obj
+            self.cache.set(key, entry, self.timeout)
+
+    def invalidate(self, sender, instance, **kwargs):
+        if self.labels is not None and self.label(sender) not in self.labels:
+            return
+        using = kwargs.get('using') or instance._state.db \
+            or DEFAULT_DB_ALIAS
+        self.cache.delete(self.key(sender, instance.pk, using))
@@ -1,8 +1,49 @@
-from django.db import models
+import hashlib
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db import connections, models, router, transaction
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.related import add_lazy_relation
 from django.db.models.related import RelatedObject
 from django.utils.functional import curry
 
-from filch.utils import dumps, loads, convert_lookup_to_dict
+from filch import queue, serializers, stats
+from filch.stats import instrument
+from filch.utils import DenormList, DotDict, LazyDenormList, chunked, \
+    convert_lookup_to_dict, get_decode_cache
+
+
+def get_db(model, instance=None, using=None):
+    # Returns the database a change to instance was made on, from the
+    # signal's using or the instance itself. The instances of model it
+    # affects are read from and written to there.
+    if using is None and instance is not None:
+        using = instance._state.db
+    if using is None:
+        # Django 1.2 routers can't take a None instance hint.
+        if instance is None:
+            using = router.db_for_write(model)
+        else:
+            using = router.db_for_write(model, instance=instance)
+    return using
+
+
+def get_databases(model, queryset):
+    # Returns queryset to read from and the database to write the
+    # instances of model in it to. A queryset that wasn't sent to a
+    # database explicitly is written where the router sends writes,
+    # and read from there too when FILCH_READ_FROM_PRIMARY is set so
+    # a lagging replica is never copied from. Querysets that were
+    # already evaluated have been read.
+    if queryset._db is not None:
+        return queryset, queryset._db
+    using = router.db_for_write(model)
+    if getattr(settings, 'FILCH_READ_FROM_PRIMARY', False) and \
+            queryset._result_cache is None:
+        queryset = queryset.using(using)
+    return queryset, using
 
 
 class DenormManyToManyFieldDescriptor(object):
@@ -15,15 +56,10 @@ class DenormManyToManyFieldDescriptor(object):
 
     def __get__(self, instance, owner):
         items = instance.__dict__[self.field.name]
-        if isinstance(items, basestring) or items is None:
-            try:
-                items = loads(items)
-                if not isinstance(items, list):
-                    raise ValueError
-                instance.__dict__[self.field.name] = items
-            except ValueError:
-                raise ValueError("You can only pass in a python list " \
-                    "or json formated array. You passed in %s" % items)
+        if isinstance(items, (basestring, dict)) or items is None:
+            # The value is only decoded once its items are used.
+            instance.__dict__[self.field.name] = LazyDenormList(items,
+                self.field.decode_cached, self.field.empty_values)
         # We iterate over the items and only return the values
         # not the keys.
         return instance.__dict__[self.field.name]
@@ -32,25 +68,139 @@ class DenormManyToManyFieldDescriptor(object):
         instance.__dict__[self.field.name] = value
 
 
-class DenormManyToManyField(models.TextField):
+class DenormObjectDescriptor(object):
+    """Field descriptor for denormalizing bits of data from a single
+    related object.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        value = instance.__dict__[self.field.name]
+        if isinstance(value, basestring) or (isinstance(value, dict)
+                                             and not isinstance(value, DotDict)):
+            value = self.field.decode(value)
+            instance.__dict__[self.field.name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.name] = value
+
+
+class ChangeTrackingMixin(object):
+    """Remembers the columns of related objects that are copied when
+    they are loaded, so saves that don't change any of them can be
+    skipped.
+    """
+
+    def _watch(self, model, lookups=None):
+        # Works out which columns of model the lookups, attrs by
+        # default, are copied from so saves that change none of them
+        # can be skipped. Callable attrs, methods and lookups that end
+        # on the object itself might read anything, so they can't be.
+        if lookups is None:
+            lookups = self.attrs
+        watched = {}
+        if callable(lookups):
+            watched = None
+        else:
+            for lookup in lookups:
+                bit = lookup.split('__')[0]
+                try:
+                    if not bit:
+                        raise FieldDoesNotExist
+                    if bit == 'pk':
+                        field = model._meta.pk
+                    else:
+                        field = model._meta.get_field(bit)
+                except FieldDoesNotExist:
+                    watched = None
+                    break
+                watched[field.name] = field.attname
+        self._watched[model] = watched
+        self._track_cache_name = '_filch_%s_initial' % self.creation_counter
+
+    def _columns(self, sender, instance):
+        # Deferred columns aren't in __dict__ and are left out, so
+        # tracking never loads them.
+        return dict([(attname, instance.__dict__[attname])
+                     for attname in self._watched[sender].values()
+                     if attname in instance.__dict__])
+
+    def _track(self, sender, instance, **kwargs):
+        instance.__dict__[self._track_cache_name] = \
+            self._columns(sender, instance)
+
+    def _untrack(self, sender, instance, **kwargs):
+        # Only instances read from the database start out with the
+        # values it has. Anything built in code, e.g. by loaddata or
+        # with the pk of an existing row, is assumed to change them.
+        if instance._state.adding:
+            instance.__dict__.pop(self._track_cache_name, None)
+
+    def _has_changes(self, sender, instance, update_fields=None):
+        # Returns False when saving instance can't have changed any
+        # of the values copied from it.
+        if self._watched.get(sender) is None:
+            return True
+        if update_fields is not None:
+            return bool(set(self._watched[sender]) & set(update_fields))
+        initial = instance.__dict__.get(self._track_cache_name)
+        if initial is None:
+            return True
+        current = self._columns(sender, instance)
+        instance.__dict__[self._track_cache_name] = current
+        return current != initial
+
+    def _connect_tracking(self):
+        for model, watched in self._watched.items():
+            if watched is not None:
+                models.signals.post_init.connect(self._track, model)
+                models.signals.pre_save.connect(self._untrack, model)
+
+    def _disconnect_tracking(self):
+        for model in self._watched:
+            models.signals.post_init.disconnect(self._track, model)
+            models.signals.pre_save.disconnect(self._untrack, model)
+
+
+class DenormField(ChangeTrackingMixin, models.TextField):
+    """Base for fields that store a serialized copy of attrs of the
+    objects reached through from_field.
+    """
 
     def __init__(self, from_field, attrs, *args, **kwargs):
         self.from_field = from_field
         self.attrs = attrs
+        self.serializer_name = kwargs.pop('serializer', None)
+        self.json = kwargs.pop('json', False)
+        self.chunk_size = kwargs.pop('chunk_size', 500)
+        self._watched = {}
+        self._dependencies = {}
 
         # If attrs was passed in as a string and not a list
         # lets convert it for use later.
         if isinstance(self.attrs, basestring):
             self.attrs = list(self.attrs)
 
-        kwargs['default'] = []
         kwargs['editable'] = False
-        super(DenormManyToManyField, self).__init__(*args, **kwargs)
+        super(DenormField, self).__init__(*args, **kwargs)
 
-    def get_prep_value(self, value):
-        if not isinstance(value, basestring):
-            value = dumps(value)
-        return super(DenormManyToManyField, self).get_prep_value(value)
+    @property
+    def serializer(self):
+        serializer = serializers.get_serializer(self.serializer_name)
+        if self.json and getattr(serializer, 'tag', None) is not None:
+            raise ImproperlyConfigured("%s is stored in a JSON column and "
+                "can't use the %s serializer." % (self.name, serializer.tag))
+        return serializer
+
+    def db_type(self, connection):
+        # SQLite's JSON functions work on text so only PostgreSQL
+        # gets its own column type.
+        if self.json and 'postgresql' in connection.settings_dict['ENGINE']:
+            return 'jsonb'
+        return super(DenormField, self).db_type(connection=connection)
 
     def _resolve(self, instance, attr):
         # _resolve supports lookups that span relations. So we
@@ -73,68 +223,673 @@ class DenormManyToManyField(models.TextField):
         if callable(self.attrs):
             return self.attrs(instance)
 
-        return dict([convert_lookup_to_dict(attr, self._resolve(instance, attr))
-                     for attr 
-                     in self.attrs])
+        return self._prepare_values([self._resolve(instance, attr)
+                                     for attr
+                                     in self.attrs])
 
-    def _delete(self, instance, **kwargs):
-        for model_instance in getattr(instance, self.related_name).all():
-            self.update_instance(model_instance, [instance])
+    def _prepare_values(self, values):
+        # Builds an item from values that line up with self.attrs.
+        return dict([convert_lookup_to_dict(attr, value)
+                     for attr, value
+                     in zip(self.attrs, values)])
 
-    def _update(self, **kwargs):
-        # If its been created it's not related. We can also ignore
-        # any pre change actions.
-        action = kwargs.get('action', None)
+    def _render(self, queryset):
+        # Returns a list of (pk, item) tuples for a queryset of the
+        # related model. When every lookup in attrs is a plain column
+        # the items are built straight from values_list() rows and no
+        # model instances are created.
+        if self._values:
+            pairs = [(row[0], self._prepare_values(row[1:]))
+                     for row in queryset.values_list('pk', *self.attrs)]
+        else:
+            pairs = [(o.pk, self._prepare(o)) for o in self._optimize(queryset)]
+        stats.add('rows', len(pairs))
+        return pairs
 
-        if kwargs.get('created') or action and 'pre_' in action:
+    def _plan_lookups(self, target):
+        # Works out from self.attrs which relations have to be
+        # followed with select_related so rendering an item never has
+        # to run another query, and whether every attr is a column so
+        # values_list() can be used instead. Callable attrs can touch
+        # anything so they just get a plain select_related(). target
+        # is the model the lookups start from.
+        self._select_related = None
+        self._values = False
+        if callable(self.attrs):
             return
 
-        if action:
-            self.update_instance(kwargs["instance"])
+        select_related = set()
+        restrict = True
+        for attr in self.attrs:
+            opts = target._meta
+            path = []
+            for bit in attr.split('__'):
+                try:
+                    field = opts.get_field(bit)
+                except FieldDoesNotExist:
+                    # A method or property, which might use any column.
+                    restrict = False
+                    break
+                path.append(bit)
+                if field.rel is None:
+                    break
+                if isinstance(field, models.ManyToManyField):
+                    restrict = False
+                    break
+                select_related.add('__'.join(path))
+                opts = field.rel.to._meta
+            else:
+                # The lookup ends on a related object, which is
+                # rendered in full.
+                restrict = False
+
+        self._select_related = sorted(select_related)
+        # Every lookup is a column so values_list() can be used.
+        self._values = restrict
+
+    def _follow(self, target):
+        # Finds the models the attrs reach by following ForeignKeys
+        # from target, mapped to the lookups that lead to them, so
+        # saving one of them can refresh the instances that copied
+        # from it.
+        self._dependencies = {}
+        if callable(self.attrs):
+            return
+        lookups = {}
+        for attr in self.attrs:
+            opts = target._meta
+            bits = attr.split('__')
+            for i, bit in enumerate(bits):
+                try:
+                    field = opts.get_field(bit)
+                except FieldDoesNotExist:
+                    break
+                if field.rel is None \
+                        or isinstance(field, models.ManyToManyField) \
+                        or isinstance(field.rel.to, basestring):
+                    break
+                model = field.rel.to
+                # Saves of target itself are already followed and
+                # share its change tracking.
+                if model is target:
+                    break
+                path = '__'.join(bits[:i + 1])
+                paths = self._dependencies.setdefault(model, [])
+                if path not in paths:
+                    paths.append(path)
+                lookups.setdefault(model, []).append('__'.join(bits[i + 1:]))
+                opts = model._meta
+
+        for model, rest in lookups.items():
+            self._watch(model, rest)
+
+    def _optimize(self, queryset, prefix=None):
+        # Applies what _plan_lookups worked out to a queryset of the
+        # related model, or to a queryset that reaches the related
+        # model through prefix.
+        if self._select_related is None:
+            return queryset.select_related()
+        if prefix is None:
+            lookups = self._select_related
         else:
-            for instance in getattr(kwargs["instance"], self.related_name).all():
-                self.update_instance(instance)
+            lookups = [prefix] + ['%s__%s' % (prefix, l)
+                                  for l in self._select_related]
+        if lookups:
+            queryset = queryset.select_related(*lookups)
+        return queryset
+
+    def refresh(self, pks, using=None):
+        # Refreshes the instances of self.model with the given pks.
+        # Without using they are read from and written to the database
+        # the router sends writes to.
+        manager = self.model._base_manager.using(
+            get_db(self.model, using=using))
+        values = {}
+        for chunk in chunked(sorted(set(pks)), self.chunk_size):
+            values.update(self.update_queryset(manager.filter(pk__in=chunk)))
+        return values
+
+    def _write(self, values, using=None):
+        # Instances that end up with the same value are updated
+        # together, in chunks small enough to stay below the
+        # database's limit on query parameters. The rest get their
+        # own value from a CASE on the pk, a chunk per statement.
+        # Rows that already hold the value are left alone.
+        instance_pks_by_value = {}
+        for instance_pk, value in values.items():
+            instance_pks_by_value.setdefault(value, []).append(instance_pk)
+
+        manager = self.model._base_manager.using(using)
+        single = {}
+        for value, instance_pks in instance_pks_by_value.items():
+            if len(instance_pks) == 1:
+                single[instance_pks[0]] = value
+                continue
+            stats.add('owners', len(instance_pks))
+            stats.add('bytes', len(value) * len(instance_pks))
+            for chunk in chunked(sorted(instance_pks), self.chunk_size):
+                manager.filter(pk__in=chunk).exclude(
+                    **{self.name: value}).update(**{self.name: value})
+        if single:
+            self._write_each(single, using)
+
+    def _write_each(self, values, using=None):
+        if using is None:
+            using = router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        pk = qn(self.model._meta.pk.column)
+        column = qn(self.column)
+        placeholder = '%s'
+        if self.db_type(connection=connection) == 'jsonb':
+            placeholder = 'CAST(%s AS jsonb)'
+
+        # Every row takes five parameters, so a statement has about as
+        # many as a chunk of pks does.
+        cursor = connection.cursor()
+        for chunk in chunked(sorted(values), max(1, self.chunk_size // 5)):
+            case = 'CASE %s %s END' % (pk, ' '.join(
+                ['WHEN %%s THEN %s' % placeholder] * len(chunk)))
+            params = []
+            for instance_pk in chunk:
+                params.extend([instance_pk, self.get_db_prep_save(
+                    values[instance_pk], connection=connection)])
+                stats.add('bytes', len(values[instance_pk]))
+            stats.add('owners', len(chunk))
+            cursor.execute('UPDATE %s SET %s = %s WHERE %s IN (%s) '
+                'AND (%s IS NULL OR %s <> %s)' % (
+                qn(self.model._meta.db_table), column, case, pk,
+                ', '.join(['%s'] * len(chunk)), column, column, case),
+                params + list(chunk) + params)
+        transaction.commit_unless_managed(using=using)
+
+    def south_field_triple(self):
+        "Returns a suitable description of this field for South."
+        from south.modelsinspector import introspector
+
+        field_class = "django.db.models.fields.TextField"
+        args, kwargs = introspector(self)
+        return (field_class, args, kwargs)
+
+
+class DenormListField(DenormField):
+    """Base for fields that store a list of items, one for each of
+    the objects reached through from_field.
+    """
+
+    deferred = False
+
+    def __init__(self, from_field, attrs, *args, **kwargs):
+        self.layout = kwargs.pop('layout', 'rows')
+
+        kwargs['default'] = []
+        super(DenormListField, self).__init__(from_field, attrs,
+                                              *args, **kwargs)
+
+        if self.layout not in ('rows', 'columns'):
+            raise ValueError("layout must be 'rows' or 'columns'")
+        if self.layout == 'columns' and callable(self.attrs):
+            raise ValueError("The columns layout needs attrs to be a list "
+                             "of lookups.")
+
+    def get_prep_value(self, value):
+        if isinstance(value, LazyDenormList):
+            if value.loaded:
+                value = value.items
+            else:
+                value = value.value
+        if isinstance(value, DenormList) and value.pks is not None:
+            value = self.encode(value, value.pks)
+        elif not isinstance(value, basestring):
+            value = self.serializer.dumps(value)
+        return super(DenormListField, self).get_prep_value(value)
+
+    def encode(self, items, pks):
+        # The pk of the related object each item came from is stored
+        # next to the items so single items can be added or removed
+        # without rebuilding the whole list.
+        if self.layout == 'columns':
+            # The attrs are written once and every item as a list of
+            # their values.
+            return self.serializer.dumps({
+                'columns': list(self.attrs),
+                'rows': [[self._lookup(item, attr) for attr in self.attrs]
+                         for item in items],
+                'pks': list(pks),
+            })
+        return self.serializer.dumps({'pks': list(pks), 'items': list(items)})
+
+    def _lookup(self, item, attr):
+        # Returns the value attr, e.g. location__name, has in item.
+        value = item
+        for bit in attr.split('__'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(bit)
+        return value
+
+    def decode(self, value):
+        # Values stored before pks were recorded are plain lists.
+        value = serializers.decode(value, self.serializer)
+        if isinstance(value, list):
+            return DenormList(value)
+        if isinstance(value, dict) and 'items' in value:
+            return DenormList(value['items'], value.get('pks'))
+        if isinstance(value, dict) and 'columns' in value:
+            return DenormList(self._unpack(value['columns'], value['rows']),
+                              value.get('pks'))
+        raise ValueError
+
+    def _unpack(self, columns, rows):
+        # Builds the items of the columns layout as nested dicts like
+        # the ones the rows layout stores. The columns they were
+        # stored with are used, so values stay readable after attrs
+        # change.
+        paths = [(column.split('__')[:-1], column.split('__')[-1])
+                 for column in columns]
+        if not [parents for parents, key in paths if parents]:
+            return [dict(zip(columns, row)) for row in rows]
+        items = []
+        for row in rows:
+            item = {}
+            for (parents, key), value in zip(paths, row):
+                target = item
+                for bit in parents:
+                    target = target.setdefault(bit, {})
+                target[key] = value
+            items.append(item)
+        return items
+
+    def decode_cached(self, value):
+        # Identical values are common, e.g. everyone in the same
+        # groups, so decoded values can be kept in a process wide
+        # cache. Items are shared between the lists handed out and
+        # should be treated as read only when the cache is enabled.
+        cache = get_decode_cache()
+        if cache is None or not isinstance(value, basestring):
+            return self.decode(value)
+        key = hashlib.md5(value.encode('utf-8')).hexdigest()
+        items = cache.get(key)
+        if items is None:
+            items = self.decode(value)
+            cache.set(key, items)
+        return DenormList(items, items.pks)
+
+    @property
+    def empty_values(self):
+        # Stored values that are known to hold no items.
+        return ('[]', self.encode([], []))
+
+    def _patch(self, instance_pks, add=(), remove=(), using=None):
+        # Adds the (pk, item) tuples in add to and removes the pks in
+        # remove from the stored values of instance_pks without
+        # loading the rest of their related objects. Values that
+        # can't be patched are rebuilt from scratch instead.
+        remove = set(remove)
 
+        values = {}
+        changed = {}
+        rebuild = []
+        manager = self.model._base_manager.using(using)
+        for chunk in chunked(instance_pks, self.chunk_size):
+            for instance_pk, value in manager.filter(pk__in=chunk) \
+                    .values_list('pk', self.name):
+                try:
+                    items = self.decode(value)
+                except (TypeError, ValueError):
+                    items = None
+                if items is None or items.pks is None \
+                        or len(items.pks) != len(items):
+                    rebuild.append(instance_pk)
+                    continue
+                pairs = [(pk, item) for pk, item in zip(items.pks, items)
+                         if pk not in remove]
+                current = set(pk for pk, item in pairs)
+                pairs.extend((pk, item) for pk, item in add
+                             if pk not in current)
+                values[instance_pk] = self.encode(
+                    [item for pk, item in pairs], [pk for pk, item in pairs])
+                if values[instance_pk] != value:
+                    changed[instance_pk] = values[instance_pk]
+
+        self._write(changed, using)
+        if rebuild:
+            values.update(self.refresh(rebuild, using))
+        return values
+
+    def _prefetch_names(self):
+        # The names the related objects can be prefetched under.
+        return [self.from_field]
+
+    def _prefetched(self, instance):
+        # Returns the related objects of instance when they have been
+        # loaded with prefetch_related(), along with every relation
+        # the attrs follow from them, and None otherwise.
+        cache = getattr(instance, '_prefetched_objects_cache', None)
+        if not cache:
+            return None
+        for name in self._prefetch_names():
+            if name in cache:
+                objects = list(cache[name])
+                for obj in objects:
+                    if not self._loaded(obj):
+                        return None
+                return objects
+        return None
+
+    def _loaded(self, obj):
+        # Whether every relation in the attrs is already cached on
+        # obj, so rendering it won't run any queries.
+        for path in self._select_related or ():
+            current = obj
+            for bit in path.split('__'):
+                field = current._meta.get_field(bit)
+                if hasattr(field, 'is_cached'):
+                    cached = field.is_cached(current)
+                else:
+                    cached = hasattr(current, field.get_cache_name())
+                if not cached:
+                    return False
+                current = getattr(current, bit)
+                if current is None:
+                    break
+        return True
+
+    def _from_prefetched(self, instances):
+        # Returns the values of instances when all of them have their
+        # related objects prefetched, and None otherwise.
+        values = {}
+        for instance in instances:
+            objects = self._prefetched(instance)
+            if objects is None:
+                return None
+            stats.add('rows', len(objects))
+            values[instance.pk] = self.encode(
+                [self._prepare(o) for o in objects], [o.pk for o in objects])
+        return values
+
+    def refresh_from_prefetched(self, queryset):
+        """Recomputes the values of the instances in queryset, or in
+        any list of instances, from the related objects they already
+        hold, e.g. from prefetch_related('groups__location'), and
+        writes them without reading anything else. Raises ValueError
+        if an instance doesn't hold everything needed.
+        """
+        instances = list(queryset)
+        values = self._from_prefetched(instances)
+        if values is None:
+            raise ValueError("Every instance needs %s prefetched along "
+                "with the relations in attrs." % self.from_field)
+        if instances:
+            self._write(values, get_db(self.model, instances[0]))
+        for instance in instances:
+            instance.__dict__[self.name] = values[instance.pk]
+        return values
+
+    @instrument('update_instance')
     def update_instance(self, instance, remove=None, objects=None):
         if remove is None:
             remove = []
+        using = get_db(self.model, instance)
+        if objects is None:
+            objects = self._prefetched(instance)
         if objects is None:
-            objects = getattr(instance, self.from_field).all()
+            pairs = self._render(
+                getattr(instance, self.from_field).all().using(using))
+        else:
+            pairs = [(o.pk, self._prepare(o)) for o in objects]
 
-        items = [self._prepare(o) for o in objects
-                 if o not in remove]
+        remove = set(o.pk for o in remove)
+        pairs = [(pk, item) for pk, item in pairs if pk not in remove]
 
-        instance.__dict__[self.name] = dumps(items)
-        instance.__class__.objects.filter(pk=instance.pk).update(
-            **{self.name: instance.__dict__[self.name]})
+        value = self.encode(
+            [item for pk, item in pairs], [pk for pk, item in pairs])
+        current = instance.__dict__.get(self.name)
+        # There's nothing to write if the instance already holds it.
+        if current is not None and self.get_prep_value(current) == value:
+            return
+        instance.__dict__[self.name] = value
+        instance.__class__.objects.using(using).filter(pk=instance.pk).update(
+            **{self.name: value})
+        stats.add('owners', 1)
+        stats.add('bytes', len(value))
 
+    @instrument('update_queryset')
     def update_queryset(self, queryset):
+        queryset, using = get_databases(self.model, queryset)
+
+        # A queryset that has been evaluated with its related objects
+        # prefetched already holds everything.
+        values = None
+        if getattr(queryset, '_result_cache', None) is not None \
+                and getattr(queryset, '_iter', None) is None:
+            values = self._from_prefetched(queryset._result_cache)
+        if values is None:
+            values = self._collect(queryset)
+
+            # Instances without any related objects are not in the
+            # through table but still need to be reset.
+            for instance_pk in queryset.values_list('pk', flat=True):
+                values.setdefault(instance_pk, self.encode([], []))
+
+        self._write(values, using)
+        return values
+
+    def _dependent_pks(self, sender, instance, using):
+        # Returns the pks of the instances of self.model that copied
+        # something from instance, one of the models in
+        # self._dependencies.
+        raise NotImplementedError
+
+    @instrument('update')
+    def _update_dependency(self, sender, instance, created=False, **kwargs):
+        # A new object can't be referenced yet.
+        if created or not self._has_changes(sender, instance,
+                                            kwargs.get('update_fields')):
+            return
+        using = get_db(self.model, instance, kwargs.get('using'))
+        pks = self._dependent_pks(sender, instance, using)
+        if pks and not self._postpone(pks, using):
+            self.refresh(pks, using)
+
+    def _delete_dependency(self, sender, instance, **kwargs):
+        using = get_db(self.model, instance, kwargs.get('using'))
+        self._deleting(sender, instance,
+                       self._dependent_pks(sender, instance, using), using)
+
+    def _deleting(self, sender, instance, pks, using):
+        # Called from pre_delete with the pks of the instances of
+        # self.model that instance is about to be removed from. A
+        # delete sends every pre_delete before the first post_delete,
+        # so each instance affected by something deleted together is
+        # refreshed once, after the last of what it copied from is gone.
+        if pks and not self._postpone(pks, using):
+            queue.begin_delete(self, sender, instance, pks, using)
+
+    @instrument('delete')
+    def _deleted(self, sender, instance, **kwargs):
+        using = get_db(self.model, instance, kwargs.get('using'))
+        pks = queue.end_delete(self, sender, instance, using)
+        if pks:
+            self.refresh(pks, using)
+
+    def _postpone(self, pks, using):
+        # Returns True when the instances with pks are refreshed
+        # later, at the end of a bulk block or by the queue, instead
+        # of right away.
+        if queue.batching():
+            queue.batch(self, pks, using)
+            return True
+        if self.deferred:
+            queue.mark_dirty(self, pks, using)
+            return True
+        return False
+
+    def _connect_dependencies(self):
+        for model in self._dependencies:
+            models.signals.post_save.connect(self._update_dependency, model)
+            models.signals.pre_delete.connect(self._delete_dependency, model)
+            models.signals.post_delete.connect(self._deleted, model)
+
+    def _disconnect_dependencies(self):
+        for model in self._dependencies:
+            models.signals.post_save.disconnect(self._update_dependency, model)
+            models.signals.pre_delete.disconnect(self._delete_dependency, model)
+            models.signals.post_delete.disconnect(self._deleted, model)
+
+    def contribute_to_class(self, cls, name):
+        super(DenormListField, self).contribute_to_class(cls, name)
+
+        setattr(cls, name, DenormManyToManyFieldDescriptor(self))
+
+
+class DenormManyToManyField(DenormListField):
+
+    def __init__(self, from_field, attrs, *args, **kwargs):
+        self.deferred = kwargs.pop('deferred', False)
+        super(DenormManyToManyField, self).__init__(from_field, attrs,
+                                                    *args, **kwargs)
+
+    def _delete(self, sender, instance, **kwargs):
+        using = get_db(self.model, instance, kwargs.get('using'))
+        self._deleting(sender, instance, self._related_pks(instance, using),
+                       using)
+
+    @instrument('update')
+    def _update(self, **kwargs):
+        # If its been created it's not related.
+        if kwargs.get('created'):
+            return
+
+        action = kwargs.get('action', None)
+        using = get_db(self.model, kwargs['instance'],
+                       kwargs.pop('using', None))
+        if action:
+            self._update_m2m(using=using, **kwargs)
+        elif not self._has_changes(kwargs['sender'], kwargs['instance'],
+                                   kwargs.get('update_fields')):
+            return
+        elif queue.batching() or self.deferred:
+            self._postpone(self._related_pks(kwargs["instance"], using), using)
+        else:
+            self.update_related(kwargs["instance"], using)
+
+    def _update_m2m(self, action, instance, reverse, model, pk_set,
+                    using=None, **kwargs):
+        if reverse:
+            # The change was made from the related side so instance
+            # is the related object and pk_set holds pks of self.model.
+            # A clear doesn't come with a pk_set, so we have to look
+            # them up while the through rows still exist.
+            if action == 'pre_clear':
+                instance.__dict__[self._clear_cache_name] = \
+                    self._related_pks(instance, using)
+            elif action == 'post_clear':
+                pk_set = instance.__dict__.pop(self._clear_cache_name, [])
+            instance_pks = pk_set
+        else:
+            instance_pks = [instance.pk]
+
+        # We can ignore any pre change actions.
+        if 'pre_' in action or not instance_pks:
+            return
+
+        if self._postpone(instance_pks, using):
+            return
+
+        if action == 'post_add':
+            if reverse:
+                added = [(instance.pk, self._prepare(instance))]
+            else:
+                added = self._render(
+                    model._base_manager.using(using).filter(pk__in=pk_set))
+            values = self._patch(instance_pks, add=added, using=using)
+        elif action == 'post_remove':
+            values = self._patch(instance_pks,
+                remove=reverse and [instance.pk] or pk_set, using=using)
+        elif reverse:
+            values = self._patch(instance_pks, remove=[instance.pk],
+                                 using=using)
+        else:
+            values = {instance.pk: self.encode([], [])}
+            self._write(values, using)
+
+        if not reverse and instance.pk in values:
+            instance.__dict__[self.name] = values[instance.pk]
+
+    def update_related(self, instance, using=None):
+        # Refresh every instance of self.model that is related to
+        # instance. All of them are gathered with a single query on
+        # the through table and written back in bulk.
+        using = get_db(self.model, instance, using)
+        queryset = self.model._base_manager.using(using).filter(
+            **{self.from_field: instance})
+        self._write(self._collect(queryset), using)
+
+    def _dependent_pks(self, sender, instance, using):
+        # A single query joining the through table to the models
+        # between it and instance.
+        m2m_reverse_field_name = self.related.field.m2m_reverse_field_name()
+        pks = set()
+        for path in self._dependencies[sender]:
+            pks.update(self.related.through._base_manager.using(using).filter(
+                **{'%s__%s' % (m2m_reverse_field_name, path): instance}
+                ).values_list(self.related.field.m2m_field_name(),
+                              flat=True).distinct())
+        return sorted(pks)
+
+    def _related_pks(self, instance, using):
+        # Returns the pks of the instances of self.model that are
+        # related to instance, straight from the through table.
+        return list(self.related.through._base_manager.using(using).filter(
+            **{self.related.field.m2m_reverse_field_name(): instance}
+            ).values_list(self.related.field.m2m_field_name(), flat=True))
+
+    def _collect(self, queryset):
+        # Returns a dict mapping the pk of every instance in queryset
+        # that has related objects to its serialized value.
+
         # The name of the FK from the m2m through model to self.model
         m2m_field_name = self.related.field.m2m_field_name()
 
         # The name of the FK from the m2m through model to the target model
         m2m_reverse_field_name = self.related.field.m2m_reverse_field_name()
 
-        m2m_objects = self.related.through._base_manager.filter(
-            **{"%s__in" % m2m_field_name: queryset}).select_related()
+        m2m_objects = self.related.through._base_manager.using(
+            queryset._db).filter(**{"%s__in" % m2m_field_name: queryset})
 
-        m2m_objects_by_instance_id = {}
-        for m2m_obj in m2m_objects:
-            instance_pk = getattr(m2m_obj, "%s_id" % m2m_field_name)
-            m2m_objects_by_instance_id.setdefault(instance_pk, []).append(m2m_obj)
-
-        for instance in queryset:
-            m2m_objs = m2m_objects_by_instance_id.get(instance.pk, [])
-            self.update_instance(instance,
-                                 objects=[getattr(o, m2m_reverse_field_name)
-                                          for o in m2m_objs])
+        pairs_by_instance_id = {}
+        if self._values:
+            lookups = ['%s__%s' % (m2m_reverse_field_name, attr)
+                       for attr in self.attrs]
+            for row in m2m_objects.values_list(m2m_field_name,
+                    m2m_reverse_field_name, *lookups).iterator():
+                pairs_by_instance_id.setdefault(row[0], []).append(
+                    (row[1], self._prepare_values(row[2:])))
+        else:
+            m2m_objects = self._optimize(m2m_objects, m2m_reverse_field_name)
+            for m2m_obj in m2m_objects.iterator():
+                instance_pk = getattr(m2m_obj, "%s_id" % m2m_field_name)
+                pairs_by_instance_id.setdefault(instance_pk, []).append(
+                    (getattr(m2m_obj, "%s_id" % m2m_reverse_field_name),
+                     self._prepare(getattr(m2m_obj, m2m_reverse_field_name))))
 
+        values = {}
+        for instance_pk, pairs in pairs_by_instance_id.items():
+            stats.add('rows', len(pairs))
+            values[instance_pk] = self.encode(
+                [item for pk, item in pairs], [pk for pk, item in pairs])
+        return values
 
     def _connect_signals_receiver(self, sender, **kwargs):
         assert self.model is sender
 
         self.related = getattr(self.model, self.from_field)
         self.related_name = RelatedObject(None, self.model, self.related.field).get_accessor_name()
+        self._clear_cache_name = '_%s_clear_pks' % self.name
+        self._plan_lookups(self.related.field.rel.to)
+        self._watch(self.related.field.rel.to)
+        self._follow(self.related.field.rel.to)
 
         self.connect_signals()
 
@@ -150,24 +905,646 @@ class DenormManyToManyField(models.TextField):
                                          self.related.field.rel.to)
         models.signals.pre_delete.connect(self._delete,
                                           self.related.field.rel.to)
+        models.signals.post_delete.connect(self._deleted,
+                                           self.related.field.rel.to)
+        self._connect_tracking()
+        self._connect_dependencies()
 
     def disconnect_signals(self):
         models.signals.m2m_changed.disconnect(self._update, self.related.through)
         models.signals.post_save.disconnect(self._update, self.related.field.rel.to)
-        models.signals.pre_delete.connect(self._delete, self.related.field.rel.to)
+        models.signals.pre_delete.disconnect(self._delete, self.related.field.rel.to)
+        models.signals.post_delete.disconnect(self._deleted, self.related.field.rel.to)
+        self._disconnect_tracking()
+        self._disconnect_dependencies()
 
     def contribute_to_class(self, cls, name):
         super(DenormManyToManyField, self).contribute_to_class(cls, name)
 
-        setattr(cls, name, DenormManyToManyFieldDescriptor(self))
+        models.signals.class_prepared.connect(self._connect_signals_receiver, self.model)
+
+
+class DenormRelatedSetField(DenormListField):
+    """Stores a list of items for the objects on the other side of a
+    ForeignKey, e.g. the groups of a location when from_field is
+    ``group_set``.
+    """
+
+    def __init__(self, from_field, attrs, *args, **kwargs):
+        self.related = None
+        super(DenormRelatedSetField, self).__init__(from_field, attrs,
+                                                    *args, **kwargs)
+
+    def _connect_signals_receiver(self, sender, **kwargs):
+        # The model with the ForeignKey is usually prepared after
+        # this one, so wait until its reverse descriptor shows up.
+        if self.related is not None:
+            return
+        descriptor = getattr(self.model, self.from_field, None)
+        if descriptor is None:
+            return
+
+        self.related = descriptor.related
+        self._fk_cache_name = '_%s_fk' % self.name
+        self._plan_lookups(self.related.model)
+        self._watch(self.related.model)
+        self._follow(self.related.model)
+
+        self.connect_signals()
+
+    def _init(self, instance, **kwargs):
+        # Remember which instance of self.model the object pointed to
+        # so it can be refreshed as well if the object is moved.
+        instance.__dict__[self._fk_cache_name] = \
+            instance.__dict__.get(self.related.field.attname)
+
+    @instrument('update')
+    def _update(self, sender, instance, created, **kwargs):
+        instance_pk = getattr(instance, self.related.field.attname)
+        previous_pk = instance.__dict__.get(self._fk_cache_name)
+        instance.__dict__[self._fk_cache_name] = instance_pk
+        changed = self._has_changes(sender, instance,
+                                    kwargs.get('update_fields'))
+        using = get_db(self.model, instance, kwargs.get('using'))
+
+        if created:
+            if instance_pk is not None and \
+                    not self._postpone([instance_pk], using):
+                self._patch([instance_pk],
+                    add=[(instance.pk, self._prepare(instance))], using=using)
+            return
+        if instance_pk == previous_pk and not changed:
+            return
+        pks = [pk for pk in (instance_pk, previous_pk) if pk is not None]
+        if not self._postpone(pks, using):
+            self.refresh(pks, using)
+
+    def _delete(self, sender, instance, **kwargs):
+        instance_pk = getattr(instance, self.related.field.attname)
+        if instance_pk is not None:
+            self._deleting(sender, instance, [instance_pk], get_db(
+                self.model, instance, kwargs.get('using')))
+
+    def _prefetch_names(self):
+        # Django has used both over time.
+        return [self.related.field.related_query_name(), self.from_field]
+
+    def _dependent_pks(self, sender, instance, using):
+        pks = set()
+        for path in self._dependencies[sender]:
+            pks.update(self.related.model._base_manager.using(using).filter(
+                **{path: instance}).values_list(self.related.field.attname,
+                                                flat=True).distinct())
+        pks.discard(None)
+        return sorted(pks)
+
+    def _collect(self, queryset):
+        # Returns a dict mapping the pk of every instance in queryset
+        # that has related objects to its serialized value.
+        fk_name = self.related.field.name
+        objects = self.related.model._base_manager.using(queryset._db).filter(
+            **{"%s__in" % fk_name: queryset})
+
+        pairs_by_instance_id = {}
+        if self._values:
+            for row in objects.values_list(fk_name, 'pk',
+                    *self.attrs).iterator():
+                pairs_by_instance_id.setdefault(row[0], []).append(
+                    (row[1], self._prepare_values(row[2:])))
+        else:
+            objects = self._optimize(objects)
+            for obj in objects.iterator():
+                pairs_by_instance_id.setdefault(
+                    getattr(obj, self.related.field.attname), []).append(
+                    (obj.pk, self._prepare(obj)))
+
+        values = {}
+        for instance_pk, pairs in pairs_by_instance_id.items():
+            stats.add('rows', len(pairs))
+            values[instance_pk] = self.encode(
+                [item for pk, item in pairs], [pk for pk, item in pairs])
+        return values
+
+    def connect_signals(self):
+        models.signals.post_init.connect(self._init, self.related.model)
+        models.signals.post_save.connect(self._update, self.related.model)
+        models.signals.pre_delete.connect(self._delete, self.related.model)
+        models.signals.post_delete.connect(self._deleted, self.related.model)
+        self._connect_tracking()
+        self._connect_dependencies()
+
+    def disconnect_signals(self):
+        models.signals.post_init.disconnect(self._init, self.related.model)
+        models.signals.post_save.disconnect(self._update, self.related.model)
+        models.signals.pre_delete.disconnect(self._delete, self.related.model)
+        models.signals.post_delete.disconnect(self._deleted, self.related.model)
+        self._disconnect_tracking()
+        self._disconnect_dependencies()
+
+    def contribute_to_class(self, cls, name):
+        super(DenormRelatedSetField, self).contribute_to_class(cls, name)
+
+        models.signals.class_prepared.connect(self._connect_signals_receiver)
+
+
+class DenormAggregateMixin(ChangeTrackingMixin):
+    """Maintains an aggregate, count, sum, min or max, of attr of the
+    objects of the ManyToManyField from_field. Adds and removes apply a
+    delta with an F() expression where they can, anything else
+    recounts the affected rows.
+    """
+
+    functions = {
+        'count': models.Count,
+        'sum': models.Sum,
+        'min': models.Min,
+        'max': models.Max,
+    }
+
+    def __init__(self, from_field, function='count', attr=None, *args, **kwargs):
+        self.from_field = from_field
+        self.function = function
+        self.attr = attr
+        self.chunk_size = kwargs.pop('chunk_size', 500)
+        self._watched = {}
+        if function not in self.functions:
+            raise ValueError("function must be one of %s" % ", ".join(
+                sorted(self.functions)))
+        if function != 'count' and attr is None:
+            raise ValueError("%s needs an attr" % function)
+
+        kwargs['editable'] = False
+        super(DenormAggregateMixin, self).__init__(*args, **kwargs)
+
+    def empty_value(self):
+        # The value without any related objects, min and max have none.
+        if self.function in ('count', 'sum'):
+            return 0
+        return None
+
+    def _aggregate(self, prefix=None):
+        # prefix is the path from the queried model to the related model.
+        lookup = '__'.join([bit for bit in (prefix, self.attr) if bit])
+        return self.functions[self.function](lookup or 'pk')
+
+    def _delta(self, queryset):
+        # Returns the value added or removed by the objects in queryset.
+        return queryset.aggregate(value=self._aggregate())['value']
+
+    def _apply(self, instance_pks, queryset, remove=False):
+        # queryset is read from the database the change was made on.
+        manager = self.model._base_manager.using(queryset.db)
+        if self.function in ('count', 'sum'):
+            delta = self._delta(queryset)
+            if not delta:
+                return
+            if remove:
+                delta = -delta
+            for chunk in chunked(instance_pks, self.chunk_size):
+                manager.filter(pk__in=chunk).update(
+                    **{self.attname: models.F(self.attname) + delta})
+        elif remove:
+            self.refresh(instance_pks, exclude=queryset, using=queryset.db)
+        else:
+            value = self._delta(queryset)
+            if value is None:
+                return
+            lookup = self.function == 'min' and 'gt' or 'lt'
+            for chunk in chunked(instance_pks, self.chunk_size):
+                manager.filter(pk__in=chunk).filter(
+                    models.Q(**{'%s__isnull' % self.attname: True}) |
+                    models.Q(**{'%s__%s' % (self.attname, lookup): value})
+                ).update(**{self.attname: value})
+
+    @instrument('update')
+    def _update(self, **kwargs):
+        action = kwargs.get('action', None)
+        using = get_db(self.model, kwargs['instance'],
+                       kwargs.pop('using', None))
+        if action:
+            self._update_m2m(using=using, **kwargs)
+        elif not kwargs.get('created') and self.function != 'count' and \
+                self._has_changes(kwargs['sender'], kwargs['instance'],
+                                  kwargs.get('update_fields')):
+            # A count doesn't depend on the related object's values.
+            pks = self._related_pks(kwargs['instance'], using)
+            if queue.batching():
+                queue.batch(self, pks, using)
+            else:
+                self.refresh(pks, using=using)
+
+    def _update_m2m(self, action, instance, reverse, model, pk_set,
+                    using=None, **kwargs):
+        # A remove sends every pk it was given, related or not, so the
+        # ones that are related are looked up while the through rows
+        # still exist.
+        if action == 'pre_remove':
+            instance.__dict__[self._remove_cache_name] = \
+                self._removed_pks(instance, reverse, pk_set, using)
+            return
+        elif action == 'post_remove':
+            pk_set = instance.__dict__.pop(self._remove_cache_name, pk_set)
+
+        if reverse:
+            if action == 'pre_clear':
+                instance.__dict__[self._clear_cache_name] = \
+                    self._related_pks(instance, using)
+            elif action == 'post_clear':
+                pk_set = instance.__dict__.pop(self._clear_cache_name, [])
+            instance_pks = pk_set
+            objects = self.related.field.rel.to._base_manager.using(
+                using).filter(pk=instance.pk)
+        else:
+            instance_pks = [instance.pk]
+            objects = model._base_manager.using(using).filter(
+                pk__in=pk_set or [])
+
+        if 'pre_' in action or not instance_pks:
+            return
+
+        if queue.batching():
+            queue.batch(self, instance_pks, using)
+            return
+        if action == 'post_add':
+            self._apply(instance_pks, objects)
+        elif action == 'post_remove':
+            self._apply(instance_pks, objects, remove=True)
+        else:
+            self.refresh(instance_pks, using=using)
+
+        if not reverse:
+            # Keep the instance in step so saving it doesn't write
+            # back the old value.
+            instance.__dict__[self.attname] = self.model._base_manager \
+                .using(using).filter(pk=instance.pk) \
+                .values_list(self.attname, flat=True)[0]
+
+    def _delete(self, sender, instance, **kwargs):
+        # As for list fields, the instances that lose objects deleted
+        # together are recounted once, after the last of them is gone.
+        using = get_db(self.model, instance, kwargs.get('using'))
+        pks = self._related_pks(instance, using)
+        if not pks:
+            return
+        if queue.batching():
+            queue.batch(self, pks, using)
+        else:
+            queue.begin_delete(self, sender, instance, pks, using)
+
+    @instrument('delete')
+    def _deleted(self, sender, instance, **kwargs):
+        using = get_db(self.model, instance, kwargs.get('using'))
+        pks = queue.end_delete(self, sender, instance, using)
+        if pks:
+            self.refresh(pks, using=using)
+
+    def _related_pks(self, instance, using):
+        return list(self.related.through._base_manager.using(using).filter(
+            **{self.related.field.m2m_reverse_field_name(): instance}
+            ).values_list(self.related.field.m2m_field_name(), flat=True))
+
+    def _removed_pks(self, instance, reverse, pk_set, using):
+        # Returns the pks in pk_set that are related to instance.
+        instance_name = self.related.field.m2m_field_name()
+        related_name = self.related.field.m2m_reverse_field_name()
+        if reverse:
+            instance_name, related_name = related_name, instance_name
+        return set(self.related.through._base_manager.using(using).filter(
+            **{instance_name: instance, '%s__in' % related_name: pk_set or []}
+            ).values_list(related_name, flat=True))
+
+    def refresh(self, pks, exclude=None, using=None):
+        manager = self.model._base_manager.using(
+            get_db(self.model, using=using))
+        for chunk in chunked(sorted(set(pks)), self.chunk_size):
+            self.update_queryset(manager.filter(pk__in=chunk), exclude)
+
+    @instrument('update_queryset')
+    def update_queryset(self, queryset, exclude=None):
+        """Recounts the value for every instance in queryset with a
+        single grouped query on the through table. Related objects in
+        exclude are left out, for when they are about to be deleted.
+        """
+        queryset, using = get_databases(self.model, queryset)
+        m2m_field_name = self.related.field.m2m_field_name()
+        m2m_reverse_field_name = self.related.field.m2m_reverse_field_name()
+
+        m2m_objects = self.related.through._base_manager.using(
+            queryset._db).filter(**{"%s__in" % m2m_field_name: queryset})
+        if exclude is not None:
+            m2m_objects = m2m_objects.exclude(
+                **{"%s__in" % m2m_reverse_field_name: exclude})
+
+        values = {}
+        for row in m2m_objects.values(m2m_field_name).annotate(
+                value=self._aggregate(m2m_reverse_field_name)):
+            values[row[m2m_field_name]] = row['value']
+
+        empty = self.empty_value()
+        for instance_pk in queryset.values_list('pk', flat=True):
+            values.setdefault(instance_pk, empty)
+
+        instance_pks_by_value = {}
+        for instance_pk, value in values.items():
+            instance_pks_by_value.setdefault(value, []).append(instance_pk)
+
+        manager = self.model._base_manager.using(using)
+        for value, instance_pks in instance_pks_by_value.items():
+            for chunk in chunked(sorted(instance_pks), self.chunk_size):
+                manager.filter(pk__in=chunk).exclude(
+                    **{self.attname: value}).update(**{self.attname: value})
+
+    def _connect_signals_receiver(self, sender, **kwargs):
+        assert self.model is sender
+
+        self.related = getattr(self.model, self.from_field)
+        self._clear_cache_name = '_%s_clear_pks' % self.name
+        self._remove_cache_name = '_%s_remove_pks' % self.name
+        if self.function != 'count':
+            self._watch(self.related.field.rel.to, [self.attr])
+
+        self.connect_signals()
+
+    def connect_signals(self):
+        models.signals.m2m_changed.connect(self._update,
+                                           self.related.through)
+        models.signals.post_save.connect(self._update,
+                                         self.related.field.rel.to)
+        models.signals.pre_delete.connect(self._delete,
+                                          self.related.field.rel.to)
+        models.signals.post_delete.connect(self._deleted,
+                                           self.related.field.rel.to)
+        self._connect_tracking()
+
+    def disconnect_signals(self):
+        models.signals.m2m_changed.disconnect(self._update, self.related.through)
+        models.signals.post_save.disconnect(self._update, self.related.field.rel.to)
+        models.signals.pre_delete.disconnect(self._delete, self.related.field.rel.to)
+        models.signals.post_delete.disconnect(self._deleted, self.related.field.rel.to)
+        self._disconnect_tracking()
+
+    def contribute_to_class(self, cls, name):
+        super(DenormAggregateMixin, self).contribute_to_class(cls, name)
 
         models.signals.class_prepared.connect(self._connect_signals_receiver, self.model)
 
 
+class DenormAggregateField(DenormAggregateMixin, models.FloatField):
+
+    def __init__(self, from_field, function, attr=None, *args, **kwargs):
+        kwargs['null'] = True
+        super(DenormAggregateField, self).__init__(from_field, function, attr,
+                                                   *args, **kwargs)
+        self.default = self.empty_value()
+
     def south_field_triple(self):
         "Returns a suitable description of this field for South."
         from south.modelsinspector import introspector
 
-        field_class = "django.db.models.fields.TextField"
+        field_class = "django.db.models.fields.FloatField"
         args, kwargs = introspector(self)
         return (field_class, args, kwargs)
+
+
+class DenormCountField(DenormAggregateMixin, models.PositiveIntegerField):
+
+    def __init__(self, from_field, *args, **kwargs):
+        kwargs['default'] = 0
+        super(DenormCountField, self).__init__(from_field, 'count', None,
+                                               *args, **kwargs)
+
+    def south_field_triple(self):
+        "Returns a suitable description of this field for South."
+        from south.modelsinspector import introspector
+
+        field_class = "django.db.models.fields.PositiveIntegerField"
+        args, kwargs = introspector(self)
+        return (field_class, args, kwargs)
+
+
+class DenormObjectField(DenormField):
+    """Base for fields that store attrs of a single related object. The
+    copy is taken when the model is saved and kept up to date when the
+    related object is saved or deleted.
+    """
+
+    def __init__(self, from_field, attrs, *args, **kwargs):
+        self._connected_models = []
+
+        kwargs['default'] = None
+        super(DenormObjectField, self).__init__(from_field, attrs,
+                                                *args, **kwargs)
+
+    def get_prep_value(self, value):
+        if not isinstance(value, basestring):
+            value = self.serializer.dumps(value)
+        return super(DenormObjectField, self).get_prep_value(value)
+
+    def decode(self, value):
+        value = serializers.decode(value, self.serializer)
+        if isinstance(value, dict):
+            return DotDict(value)
+        return value
+
+    def pre_save(self, model_instance, add):
+        try:
+            obj = getattr(model_instance, self.from_field)
+        except ObjectDoesNotExist:
+            obj = None
+        value = self._snapshot(obj)
+        model_instance.__dict__[self.attname] = value
+        return value
+
+    def _snapshot(self, obj):
+        if obj is None:
+            return self.serializer.dumps(None)
+        return self.serializer.dumps(self._prepare(obj))
+
+    def _related_queryset(self, sender, instance, using):
+        # Returns a queryset of the instances of self.model on the
+        # database using that point to instance.
+        raise NotImplementedError
+
+    def _target_columns(self):
+        # The columns of self.model that identify the object an
+        # instance points to.
+        raise NotImplementedError
+
+    def _target(self, values, using):
+        # Returns the model and pk of the object identified by values
+        # of _target_columns, or None when there is none.
+        raise NotImplementedError
+
+    @instrument('update_queryset')
+    def update_queryset(self, queryset):
+        """Copies attrs of the object every instance in queryset points
+        to again and writes the values that changed. The objects are
+        read once per chunk of instances.
+        """
+        queryset, using = get_databases(self.model, queryset)
+        empty = self._snapshot(None)
+        values = {}
+        rows = queryset.values_list('pk', *self._target_columns())
+        for chunk in chunked(rows, self.chunk_size):
+            instance_pks_by_target = {}
+            for row in chunk:
+                target = self._target(row[1:], queryset.db)
+                if target is None:
+                    values[row[0]] = empty
+                else:
+                    instance_pks_by_target.setdefault(target, []).append(
+                        row[0])
+
+            pks_by_model = {}
+            for model, pk in instance_pks_by_target:
+                pks_by_model.setdefault(model, []).append(pk)
+            for model, pks in pks_by_model.items():
+                objects = model._base_manager.using(queryset.db) \
+                    .select_related().filter(pk__in=pks)
+                for obj in objects:
+                    value = self._snapshot(obj)
+                    for instance_pk in instance_pks_by_target.pop(
+                            (model, obj.pk), ()):
+                        values[instance_pk] = value
+            # Objects that no longer exist.
+            for instance_pks in instance_pks_by_target.values():
+                for instance_pk in instance_pks:
+                    values[instance_pk] = empty
+            stats.add('rows', len(chunk))
+
+        self._write(values, using)
+        return values
+
+    def _owners(self, sender, instance, using):
+        return self._related_queryset(sender, instance,
+                                      get_db(self.model, instance, using))
+
+    @instrument('update')
+    def _update(self, sender, instance, **kwargs):
+        # A new object can't be referenced yet.
+        if kwargs.get('created'):
+            return
+        if not self._has_changes(sender, instance,
+                                 kwargs.get('update_fields')):
+            return
+        value = self._snapshot(instance)
+        owners = self._owners(sender, instance, kwargs.get('using'))
+        stats.add('owners', owners.exclude(**{self.name: value}).update(
+            **{self.name: value}))
+        stats.add('bytes', len(value))
+
+    @instrument('delete')
+    def _delete(self, sender, instance, **kwargs):
+        owners = self._owners(sender, instance, kwargs.get('using'))
+        stats.add('owners', owners.update(**{self.name: self._snapshot(None)}))
+
+    def _connect_model(self, model):
+        self._connected_models.append(model)
+        self._watch(model)
+        self._connect_model_signals(model)
+
+    def _connect_model_signals(self, model):
+        models.signals.post_save.connect(self._update, model)
+        models.signals.pre_delete.connect(self._delete, model)
+        if self._watched.get(model) is not None:
+            models.signals.post_init.connect(self._track, model)
+            models.signals.pre_save.connect(self._untrack, model)
+
+    def connect_signals(self):
+        for model in self._connected_models:
+            self._connect_model_signals(model)
+
+    def disconnect_signals(self):
+        for model in self._connected_models:
+            models.signals.post_save.disconnect(self._update, model)
+            models.signals.pre_delete.disconnect(self._delete, model)
+        self._disconnect_tracking()
+
+    def contribute_to_class(self, cls, name):
+        super(DenormObjectField, self).contribute_to_class(cls, name)
+
+        setattr(cls, name, DenormObjectDescriptor(self))
+
+
+class DenormForeignKeyField(DenormObjectField):
+    """Stores attrs of the object a ForeignKey points to. Saving that
+    object updates every row that points to it with a single query.
+    """
+
+    def _related_queryset(self, sender, instance, using):
+        return self.model._base_manager.using(using).filter(
+            **{self.from_field: instance})
+
+    def _target_columns(self):
+        return [self.model._meta.get_field(self.from_field).attname]
+
+    def _target(self, values, using):
+        if values[0] is None:
+            return None
+        return self.model._meta.get_field(self.from_field).rel.to, values[0]
+
+    def _connect_signals_receiver(self, sender, **kwargs):
+        assert self.model is sender
+
+        # The related model may not have been loaded yet.
+        add_lazy_relation(self.model, self,
+            self.model._meta.get_field(self.from_field).rel.to,
+            lambda field, model, cls: field._connect_model(model))
+
+    def contribute_to_class(self, cls, name):
+        super(DenormForeignKeyField, self).contribute_to_class(cls, name)
+
+        models.signals.class_prepared.connect(self._connect_signals_receiver, self.model)
+
+
+class DenormGenericForeignKeyField(DenormObjectField):
+    """Stores attrs of the object a GenericForeignKey points to. models
+    are the models it can point to, as classes or "app_label.Model"
+    strings. Saving or deleting one of their objects updates every row
+    that points to it with a single query.
+    """
+
+    def __init__(self, from_field, attrs, models=(), *args, **kwargs):
+        self.content_models = models
+        super(DenormGenericForeignKeyField, self).__init__(from_field, attrs,
+                                                           *args, **kwargs)
+
+    @property
+    def generic_field(self):
+        for field in self.model._meta.virtual_fields:
+            if field.name == self.from_field:
+                return field
+        raise FieldDoesNotExist("%s has no GenericForeignKey named %s" % (
+            self.model._meta.object_name, self.from_field))
+
+    def _related_queryset(self, sender, instance, using):
+        # Content type ids can differ between databases.
+        generic_field = self.generic_field
+        content_type = ContentType.objects.db_manager(using).get_for_model(
+            sender)
+        return self.model._base_manager.using(using).filter(**{
+            generic_field.ct_field: content_type,
+            generic_field.fk_field: instance.pk,
+        })
+
+    def _target_columns(self):
+        generic_field = self.generic_field
+        return [generic_field.ct_field, generic_field.fk_field]
+
+    def _target(self, values, using):
+        content_type_id, object_id = values
+        if content_type_id is None or object_id is None:
+            return None
+        model = ContentType.objects.db_manager(using).get_for_id(
+            content_type_id).model_class()
+        if model is None:
+            return None
+        return model, object_id
+
+    def contribute_to_class(self, cls, name):
+        super(DenormGenericForeignKeyField, self).contribute_to_class(cls, name)
+
+        # The models may not have been loaded yet.
+        for model in self.content_models:
+            add_lazy_relation(cls, self, model,
+                lambda field, model, cls: field._connect_model(model))
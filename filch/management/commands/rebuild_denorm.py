@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.fields import FieldDoesNotExist
+
+from filch.queue import get_field
+from filch.rebuild import rebuild, rebuild_parallel
+
+
+class Command(BaseCommand):
+    args = '<app_label.Model.field app_label.Model.field ...>'
+    help = 'Rebuilds the denormalized data stored in the given fields.'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=1000, help='Number of rows rebuilt at a time.'),
+        make_option('--start-after', dest='start_after', default=None,
+            help='Resume after the row with this pk.'),
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of processes rebuilding pk ranges in parallel.'),
+    )
+
+    def handle(self, *labels, **options):
+        if not labels:
+            raise CommandError('Enter at least one app_label.Model.field.')
+        if options['workers'] > 1 and options['start_after'] is not None:
+            raise CommandError('--start-after can only be used with one worker.')
+
+        for label in labels:
+            try:
+                field = get_field(label)
+            except (AttributeError, ValueError, FieldDoesNotExist):
+                raise CommandError('Unknown field %s.' % label)
+            if not hasattr(field, 'update_queryset'):
+                raise CommandError("%s can't be rebuilt." % label)
+
+            def progress(report):
+                self.stdout.write('%s: %d rows, last pk %s, %.1f rows/sec\n' % (
+                    label, report.processed, report.last_pk, report.rate))
+
+            if options['workers'] > 1:
+                report = rebuild_parallel(field, workers=options['workers'],
+                    chunk_size=options['chunk_size'], callback=progress)
+            else:
+                report = rebuild(field, chunk_size=options['chunk_size'],
+                    start_after=options['start_after'], callback=progress)
+            self.stdout.write('%s: rebuilt %d rows in %.1f seconds\n' % (
+                label, report.processed, report.elapsed))
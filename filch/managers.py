@@ -1,71 +1,177 @@
-from django.db import models
-from django.db.models.loading import get_model
+from multiprocessing.pool import ThreadPool
 
-from filch.utils import convert_lookup_to_dict
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, models
+
+from filch import stats
+from filch.utils import chunked, convert_lookup_to_dict
 
 
 class GenericResolutionQueryset(models.query.QuerySet):
 
+    # Number of pks looked up per pk__in query.
+    chunk_size = 500
+
+    # Maps (database, content type id) to model classes for every
+    # queryset, ids can differ between databases.
+    _models = {}
+
     def __init__(self, *args, **kwargs):
         super(GenericResolutionQueryset, self).__init__(*args, **kwargs)
         self.ordering = self.model._meta.ordering
 
-    def get_content_objects(self, querysets={}, annotate=[], select_related=True):
-        models = {}
-        objects = {}
-        results = []
-        order_fields = list(self.model._meta.ordering)
+    def get_content_objects(self, querysets={}, annotate=[], select_related=True,
+                            chunk_size=None, threads=None, cache=None):
+        """Returns the objects the items in this queryset point to.
+
+        The objects of each model are fetched with pk__in queries of
+        at most chunk_size pks. When threads is more than one the
+        models are fetched concurrently, each thread on its own
+        connection. That is only done on databases other than SQLite
+        and only sees committed data, so don't use it inside a
+        transaction that created the objects.
+
+        Pass a filch.cache.ContentObjectCache as cache to keep the
+        objects between requests.
+        """
+        with stats.measure('resolve', self.model):
+            return list(self.iter_content_objects(querysets, annotate,
+                select_related, chunk_size, threads, window=None, cache=cache))
+
+    def iter_content_objects(self, querysets={}, annotate=[], select_related=True,
+                             chunk_size=None, threads=None, window=1000,
+                             cache=None):
+        """Yields the objects the items in this queryset point to in
+        the order of the items. Items are read and resolved window
+        items at a time so only one window of objects is held in
+        memory. Sliced querysets are read within their bounds.
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
         annotate_fields = list(annotate)
-        extras = []
-        extras.extend(order_fields)
-        extras.extend(annotate_fields)
-        values = self.values('pk', 'object_id', 'content_type__app_label',
-            'content_type__model', *extras)
+        values = self.values('pk', 'object_id', 'content_type', *annotate_fields)
+        if window is None:
+            for obj in self._resolve(values, querysets, annotate_fields,
+                    select_related, chunk_size, threads, cache):
+                yield obj
+            return
+
+        # The pks are read in order with a single query, then each
+        # window by pk. Unlike offsets that doesn't get slower further
+        # in and leaves the order and any slice alone.
+        values = values._clone()
+        values.query.clear_limits()
+        values.query.clear_ordering(True)
+        for pks in chunked(self.values_list('pk', flat=True), window):
+            rows_by_pk = dict((row['pk'], row)
+                              for row in values.filter(pk__in=pks))
+            rows = [rows_by_pk[pk] for pk in pks if pk in rows_by_pk]
+            for obj in self._resolve(rows, querysets, annotate_fields,
+                    select_related, chunk_size, threads, cache):
+                yield obj
+
+    def _resolve(self, values, querysets, annotate_fields, select_related,
+                 chunk_size, threads, cache):
+        # Returns the objects for rows of values() in the same order.
+        # The database already sorted the rows, so no sorting is done
+        # here.
+        objects_by_model = {}
+        references = {}
+        rows = []
         for item in values:
-            pk = item.pop('pk')
-            object_id = item.pop('object_id')
-            app_label = item.pop('content_type__app_label')
-            model_name = item.pop('content_type__model')
-            annotated = dict((k, v) for k, v in item.items() if k in annotate_fields)
-            ordering = dict((k, v) for k, v in item.items() if k in order_fields)
-            model = get_model(app_label, model_name)
-            models.setdefault(model, {}) \
-                .setdefault(object_id, []).append({
-                    'ordering': ordering,
-                    'annotated': annotated,
-                })
-        for model, objs in models.items():
-            if model in querysets:
-                qs = querysets[model]
-            else:
-                qs = model._default_manager
-            if select_related:
-                qs = qs.select_related()
-            object_list = qs.filter(pk__in=objs.keys())
-            for obj in object_list:
-                objects.setdefault(model, {})[obj.pk] = obj
-        for model, objs in models.items():
-            for pk, options_list in objs.items():
-                for options in options_list:
-                    try:
-                        fields = objects[model][pk].__dict__.copy()
-                        private_fields = dict((k, fields.pop(k)) for k in \
-                            fields.keys() if k.startswith('_'))
-                        obj = model(**fields)
-                        obj.__temp_ordering = options['ordering']
-                        for name, annotate in options['annotated'].items():
-                            k, v = convert_lookup_to_dict(name, annotate)
-                            setattr(obj, k, v)
-                        obj.__dict__.update(private_fields)
-                        results.append(obj)
-                    except KeyError:
-                        pass
-        for order in order_fields:
-            results.sort(key=lambda i: i.__temp_ordering[order])
-        for result in results:
-            del result.__temp_ordering
+            object_id = item['object_id']
+            model = self._get_model(item['content_type'])
+            if model is None:
+                continue
+            annotated = dict((k, item[k]) for k in annotate_fields)
+            objects_by_model.setdefault(model, set()).add(object_id)
+            references[(model, object_id)] = references.get((model, object_id), 0) + 1
+            rows.append((model, object_id, annotated))
+
+        args = [(model, pks, querysets.get(model), select_related, chunk_size,
+                 cache)
+                for model, pks in objects_by_model.items()]
+        if threads and threads > 1 and len(args) > 1 and self._allows_threads():
+            pool = ThreadPool(min(threads, len(args)))
+            try:
+                fetched = pool.map(self._fetch_in_thread, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            fetched = [self._fetch(*a) for a in args]
+        objects = dict(zip(objects_by_model.keys(), fetched))
+
+        results = []
+        for model, pk, annotated in rows:
+            try:
+                obj = objects[model][pk]
+            except KeyError:
+                continue
+            # An object that is referenced once is used as is, the
+            # others get a copy for every reference.
+            references[(model, pk)] -= 1
+            if references[(model, pk)]:
+                fields = obj.__dict__.copy()
+                private_fields = dict((k, fields.pop(k)) for k in \
+                    fields.keys() if k.startswith('_'))
+                obj = model(**fields)
+                obj.__dict__.update(private_fields)
+            for name, annotate in annotated.items():
+                k, v = convert_lookup_to_dict(name, annotate)
+                setattr(obj, k, v)
+            results.append(obj)
+        stats.add('rows', len(rows))
+        stats.add('objects', len(results))
         return results
 
+    def _get_model(self, content_type_id):
+        key = (self.db, content_type_id)
+        if key not in self._models:
+            content_type = ContentType.objects.db_manager(
+                self.db).get_for_id(content_type_id)
+            self._models[key] = content_type.model_class()
+        return self._models[key]
+
+    def _fetch(self, model, pks, queryset, select_related, chunk_size, cache):
+        # Returns a dict of the objects of model with pks.
+        if queryset is None:
+            queryset = model._default_manager.all()
+        # The objects are read from the database this queryset was sent
+        # to, unless the queryset passed for the model picked one.
+        if self._db is not None and queryset._db is None:
+            queryset = queryset.using(self._db)
+        if select_related:
+            queryset = queryset.select_related()
+        if cache is not None:
+            queryset_key = cache.queryset_key(queryset)
+            objects, entries = cache.get_many(model, pks, queryset_key,
+                                              queryset.db)
+            pks = [pk for pk in pks if pk not in objects]
+        else:
+            objects = {}
+        fetched = []
+        for chunk in chunked(pks, chunk_size):
+            fetched.extend(queryset.filter(pk__in=chunk))
+        if cache is not None and fetched:
+            cache.set_many(model, fetched, queryset_key, entries,
+                           queryset.db)
+        for obj in fetched:
+            objects[obj.pk] = obj
+        return objects
+
+    def _fetch_in_thread(self, args):
+        try:
+            return self._fetch(*args)
+        finally:
+            connections[self.db].close()
+
+    def _allows_threads(self):
+        # SQLite connections can't be shared between threads and each
+        # thread would see its own in-memory database.
+        engine = connections[self.db].settings_dict['ENGINE']
+        return 'sqlite' not in engine
+
 
 class GenericResolutionManager(models.Manager):
 
@@ -0,0 +1,12 @@
+from filch import queue
+
+
+class DeferredDenormalizationMiddleware(object):
+    """Flushes the filch queue once the response is ready. Place it
+    above ``TransactionMiddleware`` so the flush happens after the
+    transaction has been committed.
+    """
+
+    def process_response(self, request, response):
+        queue.flush()
+        return response
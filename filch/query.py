@@ -0,0 +1,133 @@
+from django.db import connections
+
+from filch.fields import DenormListField
+from filch.utils import dumps
+
+
+def _vendor(connection):
+    engine = connection.settings_dict['ENGINE']
+    if 'postgresql' in engine:
+        return 'postgresql'
+    if 'sqlite' in engine:
+        return 'sqlite'
+    raise NotImplementedError("Querying denormalized data isn't supported "
+                              "on %s." % engine)
+
+
+def _paths(item, prefix='$'):
+    # Flattens a nested dict into (json path, value) pairs.
+    for key, value in sorted(item.items()):
+        path = '%s.%s' % (prefix, key)
+        if isinstance(value, dict):
+            for pair in _paths(value, path):
+                yield pair
+        else:
+            yield path, value
+
+
+def _check(field):
+    # The data has to be stored as JSON for the database to read it.
+    if getattr(field, 'layout', 'rows') == 'columns':
+        raise ValueError("%s uses the columns layout, which can't be "
+                         "queried." % field.name)
+    if getattr(field.serializer, 'tag', None) is not None:
+        raise ValueError("%s uses the %s serializer, which can't be "
+                         "queried." % (field.name, field.serializer.tag))
+
+
+def _column(queryset, field):
+    qn = connections[queryset.db].ops.quote_name
+    return '%s.%s' % (qn(queryset.model._meta.db_table), qn(field.column))
+
+
+def _contains_postgresql(column, field, item):
+    # @> on jsonb matches items holding at least the given keys. Text
+    # columns are cast, which only works when every value is JSON.
+    if not field.json:
+        column = '(%s)::jsonb' % column
+    if isinstance(field, DenormListField):
+        # Values written before pks were stored are plain lists.
+        return '(%s @> %%s OR %s @> %%s)' % (column, column), \
+            [dumps({'items': [item]}), dumps([item])]
+    return '%s @> %%s' % column, [dumps(item)]
+
+
+def _contains_sqlite(column, field, item):
+    conditions = []
+    params = []
+    if isinstance(field, DenormListField):
+        value = 'json_each.value'
+    else:
+        value = column
+    for path, expected in _paths(item):
+        if expected is None:
+            conditions.append('json_extract(%s, %%s) IS NULL' % value)
+            params.append(path)
+        else:
+            if isinstance(expected, bool):
+                expected = int(expected)
+            conditions.append('json_extract(%s, %%s) = %%s' % value)
+            params.extend([path, expected])
+    where = ' AND '.join(conditions) or '1'
+    if isinstance(field, DenormListField):
+        # Values written before pks were stored are plain lists.
+        return 'EXISTS (SELECT 1 FROM json_each(COALESCE(' \
+            'json_extract(%s, \'$.items\'), %s)) WHERE %s)' % (
+            column, column, where), params
+    return where, params
+
+
+def contains(queryset, **lookups):
+    """Filters queryset on denormalized data. Each keyword names a
+    denormalized field and a dict the stored data has to hold: an item
+    of list fields or the stored object of object fields has to have
+    at least the given keys and values. Nested dicts match spanned
+    lookups, e.g. ``contains(Person.objects.all(),
+    group_list={'location': {'name': 'Chicago'}})``.
+    """
+    connection = connections[queryset.db]
+    build = {
+        'postgresql': _contains_postgresql,
+        'sqlite': _contains_sqlite,
+    }[_vendor(connection)]
+
+    where = []
+    params = []
+    for name, item in lookups.items():
+        field = queryset.model._meta.get_field(name)
+        _check(field)
+        sql, field_params = build(_column(queryset, field), field, item)
+        where.append(sql)
+        params.extend(field_params)
+    return queryset.extra(where=where, params=params)
+
+
+def index_sql(model, name, key=None, using='default'):
+    """Returns the SQL that creates an index for queries on the
+    denormalized field name of model, to be run from a migration.
+
+    On PostgreSQL it is a GIN index that serves ``contains``. On SQLite
+    it is an index on the value of key, a json path like ``$.name``,
+    which serves lookups on object fields.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(name)
+    _check(field)
+    table = model._meta.db_table
+    index_name = '%s_%s_filch' % (table, field.column)
+
+    if _vendor(connection) == 'postgresql':
+        column = qn(field.column)
+        if not field.json:
+            column = '(%s::jsonb)' % column
+        return 'CREATE INDEX %s ON %s USING gin (%s jsonb_path_ops);' % (
+            qn(index_name), qn(table), column)
+
+    if key is None:
+        raise ValueError("SQLite indexes need a key.")
+    if isinstance(field, DenormListField):
+        raise ValueError("SQLite can't index the items of %s." % name)
+    return "CREATE INDEX %s ON %s (json_extract(%s, '%s'));" % (
+        qn('%s_%s' % (index_name, key.strip('$.').replace('.', '_'))),
+        qn(table), qn(field.column), key.replace("'", "''"))
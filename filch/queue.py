@@ -0,0 +1,233 @@
+import threading
+from itertools import count
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.loading import get_model
+from django.utils.importlib import import_module
+
+from filch.utils import chunked
+
+
+class InProcessBackend(object):
+    """Queue backend that refreshes dirty instances right away in
+    the current process. This is the default and is what the tests
+    use.
+    """
+
+    def enqueue(self, field, pks, using=None):
+        field.refresh(pks, using=using)
+
+
+class State(threading.local):
+    # dirty, batched and deleting are keyed by (field, using) so
+    # changes made on different databases are refreshed on their own.
+
+    def __init__(self):
+        self.dirty = {}
+        self.scheduled = False
+        self.bulk_depth = 0
+        self.batched = {}
+        self.deleting = {}
+        self.delete_order = count()
+        self.delete_posted = False
+
+_state = State()
+
+# What is known about an object announced by begin_delete.
+PENDING, GONE, STALE = range(3)
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'FILCH_QUEUE_BACKEND',
+            'filch.queue.InProcessBackend')
+        module, attr = path.rsplit('.', 1)
+        try:
+            _backend = getattr(import_module(module), attr)()
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured("Error importing filch queue " \
+                "backend %s: %s" % (path, e))
+    return _backend
+
+
+def get_field_label(field):
+    # Returns a string identifying field that can be handed to
+    # a worker running in another process.
+    return '%s.%s.%s' % (field.model._meta.app_label,
+        field.model._meta.object_name, field.name)
+
+
+def get_field(label):
+    app_label, model_name, field_name = label.split('.')
+    return get_model(app_label, model_name)._meta.get_field(field_name)
+
+
+def process(label, pks, using=None):
+    """Entry point for workers running outside of the request.
+    Refreshes the instances with pks of the field identified
+    by label, on the database using when it is given.
+    """
+    get_field(label).refresh(pks, using=using)
+
+
+def mark_dirty(field, pks, using=None):
+    """Records that the instances of field.model with pks need to
+    be refreshed. The same pk marked several times is only refreshed
+    once when the queue is flushed.
+    """
+    _state.dirty.setdefault((field, using), set()).update(pks)
+    # Newer versions of Django can run the flush once the current
+    # transaction commits. Otherwise it is up to the middleware or
+    # the caller to call flush.
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None and not _state.scheduled:
+        _state.scheduled = True
+        on_commit(flush)
+
+
+def flush():
+    """Hands every dirty instance recorded by this thread to the
+    queue backend.
+    """
+    dirty, _state.dirty = _state.dirty, {}
+    _state.scheduled = False
+    # Deletes that never finished, e.g. because the database raised,
+    # still leave their instances to be refreshed.
+    deleting, _state.deleting = _state.deleting, {}
+    for key, objects in deleting.items():
+        for order, pks, status in objects.values():
+            dirty.setdefault(key, set()).update(pks)
+    backend = get_backend()
+    items = [(key, pks) for key, pks in dirty.items() if pks]
+    for i, ((field, using), pks) in enumerate(items):
+        try:
+            # Backends written before the database was passed along
+            # only take field and pks.
+            if using is None or using == DEFAULT_DB_ALIAS:
+                backend.enqueue(field, pks)
+            else:
+                backend.enqueue(field, pks, using)
+        except Exception:
+            # Keep what the backend didn't take for the next flush.
+            for key, pks in items[i:]:
+                _state.dirty.setdefault(key, set()).update(pks)
+            raise
+
+
+def discard():
+    _state.dirty = {}
+    _state.scheduled = False
+    _state.deleting = {}
+
+
+def begin_delete(field, sender, instance, pks, using=None):
+    """Records, from pre_delete, that instance is being deleted and
+    that the instances of field.model with pks have to be refreshed
+    once it is gone.
+    """
+    objects = _state.deleting.setdefault((field, using), {})
+    if _state.delete_posted:
+        # A new delete starts, forget what earlier deletes that never
+        # finished left behind.
+        _state.delete_posted = False
+        for obj, (order, dirty, status) in objects.items():
+            if status == STALE:
+                del objects[obj]
+    objects[(sender, instance.pk)] = [next(_state.delete_order), set(pks),
+                                      PENDING]
+
+
+def end_delete(field, sender, instance, using=None):
+    """Records, from post_delete, that instance is gone. Returns the
+    pks recorded for it that no other object being deleted along with
+    it is recorded for, and None when there are none.
+    """
+    _state.delete_posted = True
+    objects = _state.deleting.get((field, using))
+    if not objects or (sender, instance.pk) not in objects:
+        return None
+    order, dirty, status = objects.pop((sender, instance.pk))
+
+    # A delete announces everything it removes before the first
+    # post_delete, one model at a time in the order they are removed
+    # in. Objects of other models announced before instance were left
+    # behind by a delete that never finished, e.g. because a receiver
+    # raised, and so are objects of its model that still exist.
+    unknown = []
+    for obj, entry in objects.items():
+        if entry[0] > order or entry[2] != PENDING:
+            continue
+        if obj[0] is sender:
+            unknown.append(obj[1])
+        else:
+            entry[2] = STALE
+            dirty.update(entry[1])
+    if unknown:
+        existing = set()
+        for chunk in chunked(unknown, field.chunk_size):
+            existing.update(sender._base_manager.using(using).filter(
+                pk__in=chunk).values_list('pk', flat=True))
+        for pk in unknown:
+            entry = objects[(sender, pk)]
+            if pk in existing:
+                entry[2] = STALE
+                dirty.update(entry[1])
+            else:
+                entry[2] = GONE
+
+    for other_order, pks, other_status in objects.values():
+        if other_status != STALE:
+            dirty.difference_update(pks)
+    if not objects:
+        del _state.deleting[(field, using)]
+    return dirty or None
+
+
+def batching():
+    """Returns True inside a ``bulk`` block in this thread."""
+    return _state.bulk_depth > 0
+
+
+def batch(field, pks, using=None):
+    """Records that the instances of field.model with pks have to be
+    refreshed when the outermost ``bulk`` block exits.
+    """
+    _state.batched.setdefault((field, using), set()).update(pks)
+
+
+class bulk(object):
+    """Context manager that postpones the work denormalized fields do
+    for changes made in this thread. The affected instances are
+    recorded and refreshed once when the block exits, each field
+    with grouped reads and bulk writes. Other threads are unaffected.
+
+    Changes made before the block raised may already be committed, so
+    they are refreshed as well. Instances that are already in memory
+    aren't updated.
+    """
+
+    def __enter__(self):
+        _state.bulk_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _state.bulk_depth -= 1
+        if _state.bulk_depth:
+            return
+        batched, _state.batched = _state.batched, {}
+        for (field, using), pks in batched.items():
+            if not pks:
+                continue
+            if exc_type is None:
+                field.refresh(pks, using=using)
+                continue
+            # Don't hide the error with another one, e.g. when the
+            # database went away, leave the work to the queue instead.
+            try:
+                field.refresh(pks, using=using)
+            except Exception:
+                mark_dirty(field, pks, using)
@@ -0,0 +1,130 @@
+import time
+from multiprocessing import Pool
+
+from django.db import connections
+from django.db.models import Max, Min
+
+from filch.queue import get_field, get_field_label
+
+
+class RebuildReport(object):
+    """Progress of a rebuild, handed to the callback after every
+    chunk and returned once the rebuild is done.
+    """
+
+    def __init__(self, field, last_pk=None):
+        self.field = field
+        self.processed = 0
+        self.chunks = 0
+        self.last_pk = last_pk
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return self.processed / elapsed
+
+
+def rebuild(field, queryset=None, chunk_size=1000, start_after=None,
+            callback=None):
+    """Rebuilds field for every instance in queryset, or every instance
+    of field.model, in chunks of chunk_size instances ordered by pk.
+    Only one chunk is held in memory at a time. Pass the last_pk of a
+    previous report as start_after to resume an interrupted rebuild.
+    """
+    if queryset is None:
+        queryset = field.model._base_manager.all()
+    queryset = queryset.order_by('pk')
+
+    report = RebuildReport(field, start_after)
+    while True:
+        remaining = queryset
+        if report.last_pk is not None:
+            remaining = remaining.filter(pk__gt=report.last_pk)
+        pks = list(remaining.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            break
+
+        # Bounding the chunk by pk range keeps the query free of
+        # long pk__in lists.
+        field.update_queryset(remaining.filter(pk__lte=pks[-1]))
+
+        report.processed += len(pks)
+        report.chunks += 1
+        report.last_pk = pks[-1]
+        if callback is not None:
+            callback(report)
+    return report
+
+
+def split_pk_range(queryset, parts):
+    """Splits the integer pks of queryset into at most parts inclusive
+    (low, high) ranges of roughly the same width.
+    """
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    low, high = bounds['low'], bounds['high']
+    if low is None:
+        return []
+    width = max(1, (high - low + parts) // parts)
+    return [(start, min(start + width - 1, high))
+            for start in range(low, high + 1, width)]
+
+
+def _rebuild_range(args):
+    label, low, high, chunk_size = args
+    field = get_field(label)
+    report = rebuild(field,
+        field.model._base_manager.filter(pk__gte=low, pk__lte=high),
+        chunk_size=chunk_size)
+    # Workers in a pool keep their connection between ranges.
+    return low, high, report.processed, report.chunks
+
+
+def rebuild_parallel(field, workers=4, chunk_size=1000, parts=None,
+                     callback=None):
+    """Rebuilds field for every instance of field.model by splitting
+    the pk space into ranges and rebuilding them in a pool of worker
+    processes, each with its own database connection. With a single
+    worker the ranges are rebuilt in this process, which is what has
+    to be used with an in-memory SQLite database.
+    """
+    if parts is None:
+        parts = workers * 4
+    report = RebuildReport(field)
+    ranges = split_pk_range(field.model._base_manager.all(), parts)
+    tasks = [(get_field_label(field), low, high, chunk_size)
+             for low, high in ranges]
+
+    if workers > 1:
+        # Forked workers must not share the connections of this
+        # process, they each open their own.
+        for connection in connections.all():
+            connection.close()
+        pool = Pool(workers)
+        try:
+            results = pool.imap_unordered(_rebuild_range, tasks)
+            for result in results:
+                _add_range(report, result, callback)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            _add_range(report, _rebuild_range(task), callback)
+    return report
+
+
+def _add_range(report, result, callback):
+    low, high, processed, chunks = result
+    report.processed += processed
+    report.chunks += chunks
+    if report.last_pk is None or high > report.last_pk:
+        report.last_pk = high
+    if callback is not None:
+        callback(report)
@@ -0,0 +1,156 @@
+import base64
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from filch.utils import dumps, loads
+
+
+# Serializers that write JSON leave their output untagged so every
+# JSON serializer can read rows written by any other. Other formats
+# prefix their output with "<tag>:".
+SERIALIZERS = {
+    'json': 'filch.serializers.JSONSerializer',
+    'ujson': 'filch.serializers.UJSONSerializer',
+    'orjson': 'filch.serializers.OrjsonSerializer',
+    'msgpack': 'filch.serializers.MsgpackSerializer',
+}
+
+
+def _default(obj):
+    # The same conversions filch.utils.JSONEncoder makes.
+    if isinstance(obj, Decimal):
+        return str(obj)
+    elif isinstance(obj, datetime):
+        return obj.strftime('%Y-%m-%dT%H:%M:%SZ')
+    raise TypeError("%r is not serializable" % obj)
+
+
+def _prepare(value):
+    # Converts what _default handles up front, for encoders that don't
+    # take a default hook.
+    if isinstance(value, dict):
+        return dict((k, _prepare(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_prepare(v) for v in value]
+    if isinstance(value, (Decimal, datetime)):
+        return _default(value)
+    return value
+
+
+def _decimals(value):
+    # filch.utils.loads parses floats as Decimal, loaders that can't
+    # do that have their floats converted afterwards.
+    if isinstance(value, dict):
+        return dict((k, _decimals(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_decimals(v) for v in value]
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return value
+
+
+class JSONSerializer(object):
+    tag = None
+
+    def dumps(self, value):
+        return dumps(value)
+
+    def loads(self, value):
+        return loads(value)
+
+
+class UJSONSerializer(object):
+    tag = None
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self, value):
+        return self.ujson.dumps(_prepare(value), double_precision=15)
+
+    def loads(self, value):
+        return _decimals(self.ujson.loads(value))
+
+
+class OrjsonSerializer(object):
+    tag = None
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def dumps(self, value):
+        return self.orjson.dumps(value, default=_default,
+            option=self.orjson.OPT_PASSTHROUGH_DATETIME).decode('utf-8')
+
+    def loads(self, value):
+        return _decimals(self.orjson.loads(value))
+
+
+class MsgpackSerializer(object):
+    tag = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        # The field is stored as text, so the packed bytes are base64
+        # encoded.
+        packed = self.msgpack.packb(value, default=_default, use_bin_type=True)
+        return '%s:%s' % (self.tag, base64.b64encode(packed).decode('ascii'))
+
+    def loads(self, value):
+        packed = base64.b64decode(value[len(self.tag) + 1:])
+        return _decimals(self.msgpack.unpackb(packed, raw=False))
+
+
+_serializers = {}
+
+
+def get_serializer(name=None):
+    """Returns the serializer registered as name, or imported from
+    name if it is a dotted path. Defaults to the FILCH_SERIALIZER
+    setting. "auto" picks the fastest JSON serializer installed.
+    """
+    if name is None:
+        name = getattr(settings, 'FILCH_SERIALIZER', 'json')
+    if name not in _serializers:
+        if name == 'auto':
+            for candidate in ('orjson', 'ujson', 'json'):
+                try:
+                    serializer = get_serializer(candidate)
+                except ImproperlyConfigured:
+                    continue
+                break
+        else:
+            path = SERIALIZERS.get(name, name)
+            module, attr = path.rsplit('.', 1)
+            try:
+                serializer = getattr(import_module(module), attr)()
+            except (ImportError, AttributeError) as e:
+                raise ImproperlyConfigured("Error loading filch " \
+                    "serializer %s: %s" % (name, e))
+        _serializers[name] = serializer
+    return _serializers[name]
+
+
+def decode(value, serializer=None):
+    """Decodes value with the serializer named by its tag. Untagged
+    values are JSON and are read with serializer when it writes JSON.
+    """
+    # Native JSON columns hand back values that are already decoded.
+    if not isinstance(value, basestring):
+        return value
+    if value[:1] not in ('[', '{'):
+        tag, sep, rest = value.partition(':')
+        if sep and tag in SERIALIZERS:
+            return get_serializer(tag).loads(value)
+    if serializer is None or serializer.tag is not None:
+        serializer = get_serializer('json')
+    return serializer.loads(value)
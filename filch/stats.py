@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+from functools import update_wrapper
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+
+
+# Sent with the model whose fields were written, or whose objects
+# were resolved, as the sender after every measured piece of work.
+measured = Signal(providing_args=['event', 'field', 'counts', 'elapsed'])
+
+
+class MemoryCollector(object):
+    """Keeps running totals in memory, keyed by (event, model, field).
+    Every entry counts the calls, the time spent and the sum of each
+    counter.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, event, model, field, counts, elapsed):
+        key = (event, model, field)
+        self._lock.acquire()
+        try:
+            totals = self.totals.setdefault(key, {'calls': 0, 'time': 0.0})
+            totals['calls'] += 1
+            totals['time'] += elapsed
+            for name, value in counts.items():
+                totals[name] = totals.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def get(self, event, model, field=None):
+        return self.totals.get((event, model, field), {})
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.totals = {}
+        finally:
+            self._lock.release()
+
+
+class LoggingCollector(object):
+    """Logs every measurement to the ``filch`` logger at debug level."""
+
+    def __init__(self, logger='filch'):
+        self.logger = logging.getLogger(logger)
+
+    def record(self, event, model, field, counts, elapsed):
+        self.logger.debug('%s %s%s %.2fms %s', event, model,
+            field and '.%s' % field or '', elapsed * 1000,
+            ' '.join(['%s=%s' % pair for pair in sorted(counts.items())]))
+
+
+class Measurement(object):
+
+    def __init__(self, event, model, field):
+        self.event = event
+        self.model = model
+        self.field = field
+        self.counts = {}
+
+    def add(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class State(threading.local):
+
+    def __init__(self):
+        self.active = []
+
+_state = State()
+_collectors = None
+
+
+def get_collectors():
+    global _collectors
+    if _collectors is None:
+        collectors = []
+        for path in getattr(settings, 'FILCH_STATS_COLLECTORS', ()):
+            module, attr = path.rsplit('.', 1)
+            try:
+                collectors.append(getattr(import_module(module), attr)())
+            except (ImportError, AttributeError) as e:
+                raise ImproperlyConfigured("Error importing filch stats " \
+                    "collector %s: %s" % (path, e))
+        _collectors = collectors
+    return _collectors
+
+
+def add_collector(collector):
+    """Records measurements with collector as well as with the ones
+    named by the ``FILCH_STATS_COLLECTORS`` setting.
+    """
+    get_collectors().append(collector)
+
+
+def remove_collector(collector):
+    get_collectors().remove(collector)
+
+
+def _queries():
+    # Queries are logged per connection and a measured write can run
+    # on any database, so every connection is counted.
+    return sum([len(c.queries) for c in connections.all()])
+
+
+def add(name, value):
+    """Adds value to the counter name of every measurement that is
+    running in this thread.
+    """
+    for measurement in _state.active:
+        measurement.add(name, value)
+
+
+class measure(object):
+    """Measures the work done inside a with block. The counters added
+    with ``add`` while it runs, the time it took and, when DEBUG is
+    on, the number of queries it ran are handed to every collector
+    and sent with the ``measured`` signal. Nothing is measured when
+    there is no one to report to.
+    """
+
+    def __init__(self, event, model, field=None):
+        self.event = event
+        self.model = model
+        self.field = field
+        self.measurement = None
+
+    def __enter__(self):
+        if not get_collectors() and not measured.receivers:
+            return None
+        self.measurement = Measurement(self.event, self.model, self.field)
+        self.queries = _queries()
+        self.started = time.time()
+        _state.active.append(self.measurement)
+        return self.measurement
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        measurement = self.measurement
+        if measurement is None:
+            return
+        self.measurement = None
+        elapsed = time.time() - self.started
+        _state.active.remove(measurement)
+        if settings.DEBUG:
+            measurement.add('queries', _queries() - self.queries)
+
+        model = '%s.%s' % (self.model._meta.app_label,
+                           self.model._meta.object_name)
+        field = self.field and self.field.name or None
+        for collector in get_collectors():
+            collector.record(self.event, model, field, measurement.counts,
+                             elapsed)
+        measured.send(sender=self.model, event=self.event, field=self.field,
+                      counts=measurement.counts, elapsed=elapsed)
+
+
+def instrument(event):
+    """Decorator that measures a method of a denormalized field as
+    event, tagged with the field and its model.
+    """
+    def decorator(method):
+        def wrapper(self, *args, **kwargs):
+            with measure(event, self.model, self):
+                return method(self, *args, **kwargs)
+        return update_wrapper(wrapper, method)
+    return decorator
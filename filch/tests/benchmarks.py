@@ -0,0 +1,244 @@
+import gc
+import resource
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+
+from filch.tests.models import Group, Location, Person
+from filch.tests.models import Article, HomepageItem, Press, Slot
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def seed(owners, related, fanout):
+    """Creates owners people that are each in related groups, with
+    fanout people sharing every group, and a homepage with an item
+    per person.
+    """
+    field = Person._meta.get_field('group_list')
+    field.disconnect_signals()
+    try:
+        location = Location.objects.create(name='Chicago')
+        group_count = max(1, owners * related // fanout)
+        groups = [Group.objects.create(name='Group %d' % i, location=location)
+                  for i in range(group_count)]
+        people = []
+        for i in range(owners):
+            person = Person.objects.create(name='Person %d' % i)
+            person.groups.add(*[groups[(i * related + j) % group_count]
+                                for j in range(related)])
+            people.append(person)
+        field.update_queryset(Person.objects.all())
+    finally:
+        field.connect_signals()
+
+    author = User.objects.create(username='author')
+    slot = Slot.objects.create(name='main')
+    article_type = ContentType.objects.get_for_model(Article)
+    press_type = ContentType.objects.get_for_model(Press)
+    for i in range(owners):
+        if i % 2:
+            obj = Press.objects.create(name='Press %d' % i)
+            content_type = press_type
+        else:
+            obj = Article.objects.create(name='Article %d' % i, author=author)
+            content_type = article_type
+        HomepageItem.objects.create(slot=slot, content_type=content_type,
+            object_id=obj.pk, order=i)
+    return {'people': people, 'groups': groups, 'location': location}
+
+
+@benchmark
+def m2m_add(data, repeat):
+    extra = Group.objects.create(name='Extra', location=data['location'])
+    people = data['people'][:repeat]
+    def run():
+        for person in people:
+            person.groups.add(extra)
+    return run, len(people)
+
+
+@benchmark
+def m2m_remove(data, repeat):
+    people = data['people'][:repeat]
+    pairs = [(person, person.groups.all()[0]) for person in people]
+    def run():
+        for person, group in pairs:
+            person.groups.remove(group)
+    return run, len(pairs)
+
+
+@benchmark
+def related_save(data, repeat):
+    groups = data['groups'][:repeat]
+    def run():
+        for group in groups:
+            group.name = group.name + '!'
+            group.save()
+    return run, len(groups)
+
+
+@benchmark
+def related_delete(data, repeat):
+    groups = data['groups'][:repeat]
+    def run():
+        for group in groups:
+            group.delete()
+    return run, len(groups)
+
+
+@benchmark
+def update_queryset(data, repeat):
+    field = Person._meta.get_field('group_list')
+    def run():
+        field.update_queryset(Person.objects.all())
+    return run, 1
+
+
+def _layout(layout, repeat):
+    # Rewrites every person with layout and returns a run that
+    # decodes all of the stored values repeat times.
+    field = Person._meta.get_field('group_list')
+    field.layout = layout
+    try:
+        field.update_queryset(Person.objects.all())
+    finally:
+        field.layout = 'rows'
+    values = list(Person.objects.values_list('group_list', flat=True))
+    def run():
+        for i in range(repeat):
+            for value in values:
+                field.decode(value)
+    return run, repeat * len(values)
+
+
+@benchmark
+def decode_rows(data, repeat):
+    return _layout('rows', repeat)
+
+
+@benchmark
+def decode_columns(data, repeat):
+    return _layout('columns', repeat)
+
+
+@benchmark
+def get_content_objects(data, repeat):
+    def run():
+        for i in range(repeat):
+            HomepageItem.objects.all().get_content_objects()
+    return run, repeat
+
+
+def _resident():
+    # The current resident set in kilobytes, or None where /proc is
+    # not available.
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * resource.getpagesize() // 1024
+
+
+class RSSSampler(threading.Thread):
+    """Polls the current resident set while a benchmark runs and keeps
+    the highest reading. ru_maxrss can't be used for this, it is the
+    high-water mark of the whole process and rarely moves once seeding
+    has run.
+    """
+
+    def __init__(self, interval=0.001):
+        super(RSSSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.baseline = self.peak = _resident()
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.is_set():
+            self.peak = max(self.peak, _resident())
+            self.finished.wait(self.interval)
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+        self.peak = max(self.peak, _resident())
+        return self.peak - self.baseline
+
+
+def measure(run):
+    """Runs run and returns the number of queries, the wall time and
+    the peak memory it took. Memory is traced allocations when
+    tracemalloc is available and the growth of the sampled resident
+    set otherwise, both in kilobytes, or None when neither can be
+    measured.
+    """
+    gc.collect()
+    connection.queries = []
+    sampler = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+    elif _resident() is not None:
+        sampler = RSSSampler()
+        sampler.start()
+    started = time.time()
+    try:
+        run()
+    finally:
+        seconds = time.time() - started
+        peak = None
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        elif sampler is not None:
+            peak = sampler.stop()
+    return len(connection.queries), seconds, peak
+
+
+def run(names=None, owners=100, related=5, fanout=10, repeat=10):
+    """Runs the benchmarks called names, or all of them, each against
+    freshly seeded data, and returns a list of result dicts.
+    """
+    from filch import VERSION
+
+    results = []
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        call_command('flush', interactive=False, verbosity=0)
+        data = seed(owners, related, fanout)
+        op, operations = func(data, repeat)
+        queries, seconds, memory = measure(op)
+        results.append({
+            'benchmark': func.__name__,
+            'version': '.'.join(map(str, VERSION)),
+            'owners': owners,
+            'related': related,
+            'fanout': fanout,
+            'operations': operations,
+            'queries': queries,
+            'seconds': seconds,
+            'peak_memory_kb': memory,
+            'queries_per_operation': float(queries) / max(operations, 1),
+            'seconds_per_operation': seconds / max(operations, 1),
+        })
+    return results
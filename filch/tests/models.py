@@ -3,17 +3,23 @@ from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
-from filch.fields import DenormManyToManyField
+from filch.fields import DenormAggregateField, DenormCountField, \
+    DenormForeignKeyField, DenormGenericForeignKeyField, \
+    DenormManyToManyField, DenormRelatedSetField
 from filch.managers import GenericResolutionManager
 
 
 class Location(models.Model):
     name = models.CharField(max_length=50)
+    group_names = DenormRelatedSetField('group_set', attrs=('name',),
+        json=True)
 
 
 class Group(models.Model):
     name = models.CharField(max_length=50)
     location = models.ForeignKey(Location)
+    size = models.PositiveIntegerField(default=0)
+    location_data = DenormForeignKeyField('location', attrs=('name',))
 
 
 class Person(models.Model):
@@ -21,6 +27,9 @@ class Person(models.Model):
     groups = models.ManyToManyField(Group)
     group_list = DenormManyToManyField('groups',
         attrs=('name', 'location__name'))
+    group_count = DenormCountField('groups')
+    group_size = DenormAggregateField('groups', 'sum', 'size')
+    largest_group = DenormAggregateField('groups', 'max', 'size')
 
 
 class Slot(models.Model):
@@ -31,6 +40,8 @@ class HomepageItem(models.Model):
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
     content_object = generic.GenericForeignKey('content_type', 'object_id')
+    content = DenormGenericForeignKeyField('content_object', attrs=('name',),
+        models=('Article', 'Press'))
     order = models.PositiveIntegerField()
     slot = models.ForeignKey(Slot)
 
@@ -1,10 +1,23 @@
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection
-from django.test import TestCase
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+from django.core.management import call_command
+from django.db import connection, connections, models, router
+from django.test import TestCase, TransactionTestCase
+from django.utils import simplejson
+from decimal import Decimal
+from StringIO import StringIO
 
 
+import filch
+from filch import query, queue, stats
+from filch.cache import ContentObjectCache
+from filch.management.commands import rebuild_denorm
+from filch.rebuild import rebuild, rebuild_parallel, split_pk_range
+from filch import serializers, utils
 from filch.tests.models import Group, Location, Person
 from filch.tests.models import Article, HomepageItem, Press, Slot
 
@@ -121,7 +134,9 @@ class DenormManyToManyFieldTestCase(TestCase):
 
         connection.queries = []
         field.update_queryset(Person.objects.all())
-        self.assertEqual(len(connection.queries), 5)
+        # Reading the through table, the pks and one update for the
+        # three different values.
+        self.assertEqual(len(connection.queries), 3)
 
         person1 = Person.objects.get(pk=person1.pk)
         person2 = Person.objects.get(pk=person2.pk)
@@ -131,6 +146,773 @@ class DenormManyToManyFieldTestCase(TestCase):
         field.connect_signals()
         settings.DEBUG = _old_debug
 
+    def test_update_related(self):
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+
+        people = [Person.objects.create(name=name)
+                  for name in ('Maria', 'Juan', 'Pedro')]
+        for person in people:
+            person.groups.add(self.group1)
+
+        self.group1.name = 'Djangonauts'
+        self.group1.save()
+        for person in people:
+            person = Person.objects.get(pk=person.pk)
+            self.assertEqual(person.group_list, [{'name': 'Djangonauts', 'location': {'name': 'Chicago'}}])
+
+        # One query to read the through table and a single update
+        # since every person ends up with the same value.
+        field = Person._meta.get_field("group_list")
+        connection.queries = []
+        field.update_related(self.group1)
+        self.assertEqual(len(connection.queries), 2)
+
+        settings.DEBUG = _old_debug
+
+    def test_many_to_many_reverse_change(self):
+        person = Person.objects.create(name='Maria')
+        self.group1.person_set.add(self.person, person)
+        self.group2.person_set.add(person)
+        person = Person.objects.get(pk=person.pk)
+        self.assertEqual(person.group_list, [{'name': 'PyChi', 'location': {'name': 'Chicago'}}, {'name': 'WhiteSoxsFan', 'location': {'name': 'Chicago'}}])
+
+        self.group1.person_set.remove(person)
+        person = Person.objects.get(pk=person.pk)
+        self.assertEqual(person.group_list, [{'name': 'WhiteSoxsFan', 'location': {'name': 'Chicago'}}])
+
+        self.group1.person_set.clear()
+        self.group2.person_set.clear()
+        for person in Person.objects.all():
+            self.assertEqual(person.group_list, [])
+
+    def test_incremental_change(self):
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+
+        self.person.groups.add(self.group1)
+        self.assertEqual(self.person.group_list.pks, [self.group1.pk])
+
+        # Adding reads the stored value and the new group and
+        # writes the result back.
+        aggregates = [Person._meta.get_field(name) for name in
+                      ('group_count', 'group_size', 'largest_group')]
+        for field in aggregates:
+            field.disconnect_signals()
+        connection.queries = []
+        try:
+            self.person.groups.add(self.group2)
+        finally:
+            for field in aggregates:
+                field.connect_signals()
+        self.assertEqual(len([q for q in connection.queries
+                              if 'tests_person_groups' not in q['sql']]), 3)
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list.pks, [self.group1.pk, self.group2.pk])
+
+        settings.DEBUG = _old_debug
+
+        # Values stored without pks are rebuilt.
+        Person.objects.filter(pk=self.person.pk).update(group_list='[]')
+        self.person.groups.remove(self.group1)
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list, [{'name': 'WhiteSoxsFan', 'location': {'name': 'Chicago'}}])
+        self.assertEqual(person.group_list.pks, [self.group2.pk])
+
+    def test_update_instance_queries(self):
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+
+        group = Group.objects.create(name='Cubs',
+            location=Location.objects.create(name='Wrigleyville'))
+        self.person.groups.add(self.group1, self.group2, group)
+
+        # The groups and their locations are read with a single
+        # query, followed by the update.
+        field = Person._meta.get_field("group_list")
+        self.person.group_list = []
+        connection.queries = []
+        field.update_instance(self.person)
+        self.assertEqual(len(connection.queries), 2)
+        self.assertEqual(self.person.group_list[2], {'name': 'Cubs', 'location': {'name': 'Wrigleyville'}})
+
+        # Nothing is written when the value hasn't changed.
+        connection.queries = []
+        field.update_instance(self.person)
+        self.assertEqual(len(connection.queries), 1)
+
+        settings.DEBUG = _old_debug
+
+    def test_values_matches_instances(self):
+        field = Person._meta.get_field("group_list")
+        self.assertTrue(field._values)
+        self.person.groups.add(self.group1, self.group2)
+
+        values = field.update_queryset(Person.objects.all())
+        field._values = False
+        try:
+            self.assertEqual(field.update_queryset(Person.objects.all()), values)
+        finally:
+            field._values = True
+
+    def test_rebuild(self):
+        field = Person._meta.get_field("group_list")
+        field.disconnect_signals()
+        people = [Person.objects.create(name=name)
+                  for name in ('Maria', 'Juan', 'Pedro')]
+        for person in people:
+            person.groups.add(self.group1)
+        field.connect_signals()
+
+        reports = []
+        report = rebuild(field, chunk_size=2, start_after=people[0].pk,
+            callback=lambda r: reports.append(r.processed))
+        self.assertEqual(reports, [2])
+        self.assertEqual(report.last_pk, people[2].pk)
+        self.assertEqual(Person.objects.get(pk=people[0].pk).group_list, [])
+        for person in people[1:]:
+            self.assertEqual(Person.objects.get(pk=person.pk).group_list, [{'name': 'PyChi', 'location': {'name': 'Chicago'}}])
+
+        stdout = StringIO()
+        call_command('rebuild_denorm', 'tests.Person.group_list',
+            chunk_size=3, stdout=stdout)
+        self.assertTrue('rebuilt 4 rows' in stdout.getvalue())
+        self.assertEqual(Person.objects.get(pk=people[0].pk).group_list, [{'name': 'PyChi', 'location': {'name': 'Chicago'}}])
+
+    def test_rebuild_parallel(self):
+        field = Person._meta.get_field("group_list")
+        field.disconnect_signals()
+        people = [Person.objects.create(name=name)
+                  for name in ('Maria', 'Juan', 'Pedro')]
+        for person in people:
+            person.groups.add(self.group2)
+        field.connect_signals()
+
+        low = self.person.pk
+        self.assertEqual(split_pk_range(Person.objects.all(), 2),
+            [(low, low + 1), (low + 2, low + 3)])
+        self.assertEqual(split_pk_range(Person.objects.filter(pk__lt=0), 2), [])
+
+        report = rebuild_parallel(field, workers=1, parts=3)
+        self.assertEqual(report.processed, 4)
+        self.assertEqual(report.last_pk, people[2].pk)
+        for person in people:
+            self.assertEqual(Person.objects.get(pk=person.pk).group_list, [{'name': 'WhiteSoxsFan', 'location': {'name': 'Chicago'}}])
+
+    def test_lazy_decoding(self):
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertFalse(person.group_list)
+        self.assertFalse(person.group_list.loaded)
+
+        self.person.groups.add(self.group1)
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(len(person.group_list), 1)
+        self.assertTrue(person.group_list.loaded)
+
+        person.group_list.append({'name': 'Cubs'})
+        person.save()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list[1], {'name': 'Cubs'})
+
+        # It is a list wherever one is expected.
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertTrue(isinstance(person.group_list, list))
+        self.assertEqual(simplejson.loads(simplejson.dumps(person.group_list)),
+                         [{'name': 'PyChi', 'location': {'name': 'Chicago'}},
+                          {'name': 'Cubs'}])
+        self.assertEqual([None] + person.group_list[1:], [None, {'name': 'Cubs'}])
+
+    def test_decode_cache(self):
+        self.person.groups.add(self.group1)
+        person = Person.objects.create(name='Maria')
+        person.groups.add(self.group1)
+
+        utils._decode_cache = utils.LRUCache(1)
+        try:
+            people = list(Person.objects.all())
+            self.assertEqual(people[0].group_list, people[1].group_list)
+            self.assertEqual(len(utils._decode_cache), 1)
+            self.assertTrue(people[0].group_list[0] is people[1].group_list[0])
+            self.assertFalse(people[0].group_list is people[1].group_list)
+        finally:
+            utils._decode_cache = None
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_serializers(self):
+        # Every serializer writes decimals as strings and reads
+        # floats back as decimals, like filch.utils does.
+        value = {'pks': [1], 'items': [{'name': 'PyChi', 'size': Decimal('1.5'), 'ratio': 2.5}]}
+        decoded = {'pks': [1], 'items': [{'name': 'PyChi', 'size': '1.5', 'ratio': Decimal('2.5')}]}
+        for name in serializers.SERIALIZERS:
+            try:
+                serializer = serializers.get_serializer(name)
+            except ImproperlyConfigured:
+                continue
+            encoded = serializer.dumps(value)
+            self.assertEqual(serializers.decode(encoded), decoded)
+
+    def test_field_serializer(self):
+        try:
+            serializers.get_serializer('msgpack')
+        except ImproperlyConfigured:
+            return
+
+        self.person.groups.add(self.group1)
+        field = Person._meta.get_field("group_list")
+        field.serializer_name = 'msgpack'
+        try:
+            self.person.groups.add(self.group2)
+            value = Person.objects.filter(pk=self.person.pk) \
+                .values_list('group_list', flat=True)[0]
+            self.assertTrue(value.startswith('msgpack:'))
+        finally:
+            field.serializer_name = None
+
+        # Rows written in either format stay readable.
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list, [{'name': 'PyChi', 'location': {'name': 'Chicago'}}, {'name': 'WhiteSoxsFan', 'location': {'name': 'Chicago'}}])
+
+    def test_deferred(self):
+        field = Person._meta.get_field("group_list")
+        field.deferred = True
+        try:
+            self.person.groups.add(self.group1)
+            self.person.groups.add(self.group2)
+            person = Person.objects.get(pk=self.person.pk)
+            self.assertEqual(person.group_list, [])
+
+            queue.flush()
+            person = Person.objects.get(pk=self.person.pk)
+            self.assertEqual(person.group_list, [{'name': 'PyChi', 'location': {'name': 'Chicago'}}, {'name': 'WhiteSoxsFan', 'location': {'name': 'Chicago'}}])
+
+            self.group1.name = 'Djangonauts'
+            self.group1.save()
+            self.group2.delete()
+            queue.flush()
+            person = Person.objects.get(pk=self.person.pk)
+            self.assertEqual(person.group_list, [{'name': 'Djangonauts', 'location': {'name': 'Chicago'}}])
+        finally:
+            field.deferred = False
+            queue.discard()
+
+    def test_deferred_backend(self):
+        field = Person._meta.get_field("group_list")
+        field.deferred = True
+        backend = FieldAndPksBackend()
+        _old_backend = queue._backend
+        queue._backend = backend
+        try:
+            self.person.groups.add(self.group1)
+            backend.fail = True
+            self.assertRaises(ValueError, queue.flush)
+            self.assertEqual(backend.calls, [])
+
+            # The work the backend refused is handed over again.
+            backend.fail = False
+            queue.flush()
+            self.assertEqual(backend.calls, [(field, set([self.person.pk]))])
+        finally:
+            field.deferred = False
+            queue._backend = _old_backend
+            queue.discard()
+
+    def test_skip_unchanged(self):
+        self.person.groups.add(self.group1)
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+
+        # Neither the group's name nor location changed, so nothing
+        # copied from it can have.
+        group = Group.objects.get(pk=self.group1.pk)
+        group.size = 5
+        connection.queries = []
+        group.save()
+        self.assertEqual([q for q in connection.queries
+                          if 'group_list' in q['sql']], [])
+
+        # update_fields naming a copied column does fan out.
+        models.signals.post_save.send(sender=Group, instance=group,
+            created=False, update_fields=frozenset(['name']))
+        self.assertEqual(len([q for q in connection.queries
+                              if 'group_list' in q['sql']]), 1)
+
+        group.name = 'Djangonauts'
+        group.save()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list[0]['name'], 'Djangonauts')
+
+        # An instance that wasn't read from the database can change
+        # anything.
+        Group(pk=self.group1.pk, name='Renamed', location=self.location,
+              size=5).save()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list[0]['name'], 'Renamed')
+        location = Location.objects.get(pk=self.location.pk)
+        self.assertEqual(sorted(location.group_names.pks),
+                         [self.group1.pk, self.group2.pk])
+        self.assertTrue({'name': 'Renamed'} in location.group_names)
+
+        location = Location.objects.get(pk=self.location.pk)
+        connection.queries = []
+        location.save()
+        self.assertEqual([q for q in connection.queries
+                          if 'location_data' in q['sql']], [])
+
+        settings.DEBUG = _old_debug
+
+    def test_dependencies(self):
+        other = Person.objects.create(name='Joe')
+        self.person.groups.add(self.group1, self.group2)
+        other.groups.add(self.group2)
+        Person.objects.create(name='Bob')
+
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        self.location.name = 'Chicagoland'
+        self.location.save()
+        # The people are found with one query through the groups.
+        self.assertEqual(len([q for q in connection.queries
+                              if 'tests_person_groups' in q['sql']
+                              and 'SELECT DISTINCT' in q['sql']]), 1)
+        settings.DEBUG = _old_debug
+
+        for person in Person.objects.filter(pk__in=[self.person.pk, other.pk]):
+            self.assertEqual(set(item['location']['name'] for item in person.group_list),
+                             set(['Chicagoland']))
+
+        self.location.delete()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list, [])
+
+    def test_stats(self):
+        person = Person.objects.create(name='Joe')
+        person.groups.add(self.group1)
+        self.person.groups.add(self.group1, self.group2)
+
+        collector = stats.MemoryCollector()
+        stats.add_collector(collector)
+        events = []
+        def receiver(sender, **kwargs):
+            events.append((sender, kwargs['event']))
+        stats.measured.connect(receiver)
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            self.group1.name = 'Djangonauts'
+            self.group1.save()
+        finally:
+            settings.DEBUG = _old_debug
+            stats.measured.disconnect(receiver)
+            stats.remove_collector(collector)
+
+        # Both people were refreshed from the through table rows of
+        # their three groups with one read and a single update of
+        # their two values.
+        totals = collector.get('update', 'tests.Person', 'group_list')
+        self.assertEqual(totals['calls'], 1)
+        self.assertEqual(totals['owners'], 2)
+        self.assertEqual(totals['rows'], 3)
+        self.assertEqual(totals['queries'], 2)
+        self.assertTrue(totals['bytes'] > 0)
+        self.assertTrue((Person, 'update') in events)
+
+    def test_prefetched(self):
+        field = Person._meta.get_field("group_list")
+        field.disconnect_signals()
+        try:
+            self.person.groups.add(self.group1, self.group2)
+        finally:
+            field.connect_signals()
+        other = Person.objects.create(name='Joe')
+
+        # What prefetch_related('groups__location') leaves behind.
+        groups = list(Group.objects.select_related('location'))
+        people = list(Person.objects.filter(pk__in=[self.person.pk, other.pk]))
+        for person in people:
+            person._prefetched_objects_cache = {
+                'groups': person.pk == self.person.pk and groups or []}
+
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        field.update_instance(people[0])
+        self.assertEqual(len(connection.queries), 1)
+
+        connection.queries = []
+        field.refresh_from_prefetched(people)
+        self.assertEqual([q for q in connection.queries
+                          if q['sql'].startswith('SELECT')], [])
+        settings.DEBUG = _old_debug
+
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list.pks, [self.group1.pk, self.group2.pk])
+
+        # Relations the attrs follow have to be loaded too.
+        people[0]._prefetched_objects_cache['groups'] = list(Group.objects.all())
+        self.assertRaises(ValueError, field.refresh_from_prefetched, people)
+
+    def test_bulk(self):
+        people = [Person.objects.create(name=name)
+                  for name in ('Maria', 'Juan', 'Pedro')]
+
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        with filch.bulk():
+            for person in people:
+                person.groups.add(self.group1, self.group2)
+            self.group1.person_set.add(self.person)
+            # Nothing is denormalized until the block exits.
+            self.assertEqual([q for q in connection.queries
+                              if 'group_list' in q['sql']], [])
+            self.assertEqual(Person.objects.filter(group_count=0).count(), 4)
+        settings.DEBUG = _old_debug
+
+        for person in Person.objects.all():
+            self.assertEqual(person.group_list.pks, person.pk == self.person.pk
+                and [self.group1.pk] or [self.group1.pk, self.group2.pk])
+            self.assertEqual(person.group_count, len(person.group_list))
+
+        with filch.bulk():
+            with filch.bulk():
+                self.group2.delete()
+            self.assertEqual(len(Person.objects.get(pk=people[0].pk).group_list), 2)
+        self.assertEqual(len(Person.objects.get(pk=people[0].pk).group_list), 1)
+
+        # Changes made before the block raised are still refreshed.
+        try:
+            with filch.bulk():
+                people[0].groups.clear()
+                raise ValueError
+        except ValueError:
+            pass
+        person = Person.objects.get(pk=people[0].pk)
+        self.assertEqual((person.group_list, person.group_count), ([], 0))
+
+    def test_disconnect_signals_delete(self):
+        self.person.groups.add(self.group1)
+        group_pk = self.group1.pk
+        field = Person._meta.get_field("group_list")
+        field.disconnect_signals()
+        try:
+            self.group1.delete()
+        finally:
+            field.connect_signals()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list.pks, [group_pk])
+
+    def test_cascade_delete(self):
+        people = [Person.objects.create(name=name)
+                  for name in ('Maria', 'Juan', 'Pedro')]
+        for person in people:
+            person.groups.add(self.group1, self.group2)
+        group = Group.objects.create(name='Cubs', location=self.location)
+        people[0].groups.add(group)
+
+        # Deleting the location deletes all of its groups, and every
+        # person is rewritten once after the last of them is gone, by
+        # the list and by each aggregate.
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        self.location.delete()
+        for name in ('group_list', 'group_count', 'group_size',
+                     'largest_group'):
+            self.assertEqual(len([q for q in connection.queries
+                                  if q['sql'].startswith('UPDATE')
+                                  and name in q['sql']]), 1)
+        settings.DEBUG = _old_debug
+
+        for person in people:
+            person = Person.objects.get(pk=person.pk)
+            self.assertEqual(person.group_list, [])
+            self.assertEqual((person.group_count, person.group_size,
+                              person.largest_group), (0, 0, None))
+
+    def test_delete_chunked(self):
+        groups = [Group.objects.create(name='Group %d' % i,
+                                       location=self.location)
+                  for i in range(3)]
+        self.person.groups.add(*groups)
+
+        # The groups still to be deleted are looked up in chunks.
+        fields = [Person._meta.get_field(name) for name in ('group_list',
+            'group_count', 'group_size', 'largest_group')]
+        fields.append(Location._meta.get_field('group_names'))
+        for field in fields:
+            field.chunk_size = 1
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            Group.objects.filter(pk__in=[g.pk for g in groups]).delete()
+            lookups = [q['sql'] for q in connection.queries
+                       if q['sql'].startswith('SELECT "tests_group"."id" '
+                                              'FROM "tests_group" WHERE')]
+        finally:
+            for field in fields:
+                field.chunk_size = 500
+            settings.DEBUG = _old_debug
+        self.assertTrue(lookups)
+        self.assertEqual([sql for sql in lookups if ',' in sql], [])
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual((person.group_list, person.group_count), ([], 0))
+
+    def test_interrupted_delete(self):
+        self.person.groups.add(self.group1, self.group2)
+
+        def veto(sender, instance, **kwargs):
+            raise ValueError
+        models.signals.pre_delete.connect(veto, Group)
+        try:
+            self.group1.delete()
+        except ValueError:
+            pass
+        models.signals.pre_delete.disconnect(veto, Group)
+
+        self.group2.delete()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list.pks, [self.group1.pk])
+        self.group1.delete()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual(person.group_list, [])
+
+    def test_columns_layout(self):
+        field = Person._meta.get_field("group_list")
+        items = [{'name': 'Group %d' % i, 'location': {'name': 'Chicago'}}
+                 for i in range(100)]
+        pks = range(1, 101)
+        rows = field.encode(items, pks)
+        field.layout = 'columns'
+        try:
+            columns = field.encode(items, pks)
+            # Every key is written once instead of once per item.
+            self.assertTrue(len(columns) < len(rows) * 0.7)
+            decoded = field.decode(columns)
+            self.assertEqual(decoded, items)
+            self.assertEqual(decoded.pks, list(pks))
+            # Values written with the rows layout stay readable.
+            self.assertEqual(field.decode(rows), items)
+
+            self.person.groups.add(self.group1, self.group2)
+            self.person.groups.remove(self.group1)
+            stored = Person.objects.filter(pk=self.person.pk) \
+                .values_list('group_list', flat=True)[0]
+            self.assertTrue('"columns"' in stored)
+            person = Person.objects.get(pk=self.person.pk)
+            self.assertEqual(person.group_list, [{'name': 'WhiteSoxsFan', 'location': {'name': 'Chicago'}}])
+            self.assertEqual(person.group_list.pks, [self.group2.pk])
+            self.assertRaises(ValueError, query.contains, Person.objects.all(),
+                              group_list={'name': 'PyChi'})
+        finally:
+            field.layout = 'rows'
+
+    def test_aggregates(self):
+        self.group1.size = 10
+        self.group1.save()
+        self.group2.size = 25
+        self.group2.save()
+        self.assertEqual(self.person.group_count, 0)
+        self.assertEqual(self.person.group_size, 0)
+
+        self.person.groups.add(self.group1, self.group2)
+        self.assertEqual(self.person.group_count, 2)
+        self.assertEqual(self.person.group_size, 35)
+        self.assertEqual(self.person.largest_group, 25)
+
+        other = Person.objects.create(name='Joe')
+        self.group1.person_set.add(other)
+        other = Person.objects.get(pk=other.pk)
+        self.assertEqual((other.group_count, other.group_size, other.largest_group), (1, 10, 10))
+
+        self.group1.size = 40
+        self.group1.save()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual((person.group_count, person.group_size, person.largest_group), (2, 65, 40))
+
+        # A rename can't change any of them.
+        group = Group.objects.get(pk=self.group1.pk)
+        group.name = 'Renamed'
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        group.save()
+        self.assertEqual([q for q in connection.queries
+                          if 'largest_group' in q['sql']
+                          or 'group_size' in q['sql']], [])
+        settings.DEBUG = _old_debug
+
+        self.person.groups.remove(self.group1)
+        self.assertEqual((self.person.group_count, self.person.group_size, self.person.largest_group), (1, 25, 25))
+
+        # Removing objects that aren't related changes nothing.
+        self.person.groups.remove(self.group1)
+        self.group1.person_set.remove(self.person)
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual((person.group_count, person.group_size, person.largest_group), (1, 25, 25))
+
+        self.group2.delete()
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual((person.group_count, person.group_size, person.largest_group), (0, 0, None))
+
+        self.group1.person_set.clear()
+        other = Person.objects.get(pk=other.pk)
+        self.assertEqual((other.group_count, other.group_size, other.largest_group), (0, 0, None))
+
+    def test_aggregate_update_queryset(self):
+        self.person.groups.add(self.group1, self.group2)
+        Person.objects.update(group_count=0, largest_group=None)
+        for name in ('group_count', 'largest_group'):
+            Person._meta.get_field(name).update_queryset(Person.objects.all())
+        person = Person.objects.get(pk=self.person.pk)
+        self.assertEqual((person.group_count, person.largest_group), (2, 0))
+
+class DenormForeignKeyFieldTestCase(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Chicago')
+        self.group1 = Group.objects.create(
+            name='PyChi',
+            location=self.location,
+        )
+        self.group2 = Group.objects.create(
+            name='WhiteSoxsFan',
+            location=self.location,
+        )
+
+    def test_foreign_key(self):
+        self.assertEqual(self.group1.location_data, {'name': 'Chicago'})
+        group = Group.objects.get(pk=self.group1.pk)
+        self.assertEqual(group.location_data.name, 'Chicago')
+
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        self.location.name = 'Chicagoland'
+        self.location.save()
+        # Both groups are updated by a single query.
+        self.assertEqual(len([q for q in connection.queries
+                              if 'location_data' in q['sql']]), 1)
+        settings.DEBUG = _old_debug
+
+        for group in Group.objects.all():
+            self.assertEqual(group.location_data, {'name': 'Chicagoland'})
+
+    def test_rebuild(self):
+        # Rows written before the field existed hold no copy.
+        Group.objects.create(name='Djangonauts',
+            location=Location.objects.create(name='Evanston'))
+        Group.objects.update(location_data=None)
+
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        field = Group._meta.get_field('location_data')
+        field.update_queryset(Group.objects.all())
+        # Reading the groups, their locations and one update for each
+        # of the two values.
+        self.assertEqual(len(connection.queries), 4)
+        settings.DEBUG = _old_debug
+        self.assertEqual([g.location_data for g in Group.objects.all()],
+            [{'name': 'Chicago'}, {'name': 'Chicago'}, {'name': 'Evanston'}])
+
+        Group.objects.update(location_data=None)
+        stdout = StringIO()
+        call_command('rebuild_denorm', 'tests.Group.location_data',
+            stdout=stdout)
+        self.assertTrue('rebuilt 3 rows' in stdout.getvalue())
+        self.assertEqual(Group.objects.get(pk=self.group1.pk).location_data,
+                         {'name': 'Chicago'})
+
+        self.assertRaises(CommandError, rebuild_denorm.Command().handle,
+            'tests.Group.name', workers=1, start_after=None, chunk_size=1000)
+
+    def test_related_set(self):
+        location = Location.objects.get(pk=self.location.pk)
+        self.assertEqual(location.group_names, [{'name': 'PyChi'}, {'name': 'WhiteSoxsFan'}])
+        self.assertEqual(location.group_names.pks, [self.group1.pk, self.group2.pk])
+
+        self.group1.name = 'Djangonauts'
+        self.group1.save()
+        location = Location.objects.get(pk=self.location.pk)
+        self.assertEqual(location.group_names, [{'name': 'Djangonauts'}, {'name': 'WhiteSoxsFan'}])
+
+        other = Location.objects.create(name='Evanston')
+        group = Group.objects.get(pk=self.group2.pk)
+        group.location = other
+        group.save()
+        location = Location.objects.get(pk=self.location.pk)
+        self.assertEqual(location.group_names, [{'name': 'Djangonauts'}])
+        other = Location.objects.get(pk=other.pk)
+        self.assertEqual(other.group_names, [{'name': 'WhiteSoxsFan'}])
+
+        self.group1.delete()
+        location = Location.objects.get(pk=self.location.pk)
+        self.assertEqual(location.group_names, [])
+
+    def test_contains(self):
+        person = Person.objects.create(name='Sean')
+        person.groups.add(self.group1)
+        other = Person.objects.create(name='Joe')
+        other.groups.add(self.group2)
+        Person.objects.create(name='Bob')
+        # Values written before pks were stored can be queried too.
+        legacy = Person.objects.create(name='Amy')
+        Person.objects.filter(pk=legacy.pk).update(
+            group_list='[{"name": "PyChi", "location": {"name": "Chicago"}}]')
+
+        people = query.contains(Person.objects.all(), group_list={'name': 'PyChi'})
+        self.assertEqual(set(people), set([person, legacy]))
+        people = query.contains(Person.objects.all(),
+            group_list={'location': {'name': 'Chicago'}})
+        self.assertEqual(set(people), set([person, other, legacy]))
+        people = query.contains(Person.objects.all(),
+            group_list={'name': 'PyChi', 'location': {'name': 'Evanston'}})
+        self.assertEqual(list(people), [])
+
+        groups = query.contains(Group.objects.all(), location_data={'name': 'Chicago'})
+        self.assertEqual(groups.count(), 2)
+
+        locations = query.contains(Location.objects.all(), group_names={'name': 'PyChi'})
+        self.assertEqual(list(locations), [self.location])
+
+        self.assertEqual(query.index_sql(Group, 'location_data', '$.name'),
+            'CREATE INDEX "tests_group_location_data_filch_name" ON "tests_group" '
+            '(json_extract("location_data", \'$.name\'));')
+        self.assertRaises(ValueError, query.index_sql, Person, 'group_list', '$.name')
+
+        # Data that isn't stored as JSON can't be queried.
+        field = Person._meta.get_field('group_list')
+        field.serializer_name = 'msgpack'
+        try:
+            self.assertRaises(ValueError, query.contains,
+                Person.objects.all(), group_list={'name': 'PyChi'})
+        finally:
+            field.serializer_name = None
+
+    def test_json_column(self):
+        field = Location._meta.get_field('group_names')
+        field.serializer_name = 'msgpack'
+        try:
+            self.assertRaises(ImproperlyConfigured, lambda: field.serializer)
+        finally:
+            field.serializer_name = None
+        # Native JSON columns hand back decoded values.
+        location = Location(name='Evanston', group_names={'pks': [1], 'items': [{'name': 'PyChi'}]})
+        self.assertEqual(location.group_names, [{'name': 'PyChi'}])
+        self.assertEqual(location.group_names.pks, [1])
+
+
 class GenericResolutionManagerTestCase(TestCase):
 
     def setUp(self):
@@ -210,6 +992,15 @@ class GenericResolutionManagerTestCase(TestCase):
         )
 
     def test_get_content_objects(self):
+        collector = stats.MemoryCollector()
+        stats.add_collector(collector)
+        try:
+            HomepageItem.objects.all().get_content_objects()
+        finally:
+            stats.remove_collector(collector)
+        totals = collector.get('resolve', 'tests.HomepageItem')
+        self.assertEqual((totals['rows'], totals['objects']), (8, 8))
+
         items = HomepageItem.objects \
             .filter(slot=self.slot1).get_content_objects()
         self.assertEquals(len(items), 5)
@@ -228,3 +1019,359 @@ class GenericResolutionManagerTestCase(TestCase):
             .filter(slot=self.slot1).get_content_objects(annotate=('slot__name',))
         for item in items:
             self.assertTrue(hasattr(item, 'slot'))
+
+    def test_get_content_objects_batched(self):
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+
+        # One query for the items and one per model.
+        connection.queries = []
+        items = HomepageItem.objects \
+            .filter(slot=self.slot1).get_content_objects()
+        self.assertEqual(len(connection.queries), 3)
+
+        # Articles are looked up one pk at a time.
+        connection.queries = []
+        chunked_items = HomepageItem.objects \
+            .filter(slot=self.slot1).get_content_objects(chunk_size=1)
+        self.assertEqual(len(connection.queries), 5)
+        self.assertEqual(chunked_items, items)
+
+        settings.DEBUG = _old_debug
+
+        # Objects referenced more than once are separate instances.
+        self.assertEqual(items[0], items[3])
+        self.assertFalse(items[0] is items[3])
+
+    def test_iter_content_objects(self):
+        items = list(HomepageItem.objects.all().iter_content_objects(window=3))
+        self.assertEqual(items, HomepageItem.objects.all().get_content_objects())
+
+        # Items are ordered by order and then by slot name.
+        self.assertEqual(items, [
+            self.article1, self.article1, self.press1, self.press1,
+            self.article2, self.article2, self.article1, self.article3,
+        ])
+
+        items = HomepageItem.objects.order_by('-order', 'slot__name') \
+            .iter_content_objects(window=2, annotate=('slot__name',))
+        self.assertEqual([(i, i.slot['name']) for i in items], [
+            (self.article3, 'main'), (self.article1, 'main'),
+            (self.article2, 'main'), (self.article2, 'sidebar'),
+            (self.press1, 'main'), (self.press1, 'sidebar'),
+            (self.article1, 'main'), (self.article1, 'sidebar'),
+        ])
+
+        # Sliced querysets are read within their bounds.
+        self.assertEqual(list(HomepageItem.objects.all()[1:6]
+            .iter_content_objects(window=2)), [
+            self.article1, self.press1, self.press1, self.article2,
+            self.article2,
+        ])
+
+    def test_get_content_objects_cache(self):
+        cache = ContentObjectCache(get_cache('locmem://'))
+        items = HomepageItem.objects \
+            .filter(slot=self.slot1).get_content_objects(cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        self.assertEqual(HomepageItem.objects \
+            .filter(slot=self.slot1).get_content_objects(cache=cache), items)
+        self.assertEqual(len(connection.queries), 1)
+        self.assertEqual((cache.hits, cache.misses), (4, 4))
+        settings.DEBUG = _old_debug
+
+        # A custom queryset is cached separately.
+        items = HomepageItem.objects \
+            .filter(slot=self.slot1).get_content_objects(cache=cache, querysets={
+                Article: Article.published.all(),
+            })
+        self.assertEqual(len(items), 4)
+        self.assertEqual((cache.hits, cache.misses), (5, 7))
+
+        self.press1.name = 'Filch takes the world by storm'
+        self.press1.save()
+        items = HomepageItem.objects \
+            .filter(slot=self.slot1).get_content_objects(cache=cache)
+        self.assertEqual(items[1].name, 'Filch takes the world by storm')
+        self.assertEqual((cache.hits, cache.misses), (8, 8))
+
+        # Keys are dropped by caches that never read them, only for
+        # the models they listen for.
+        backend = get_cache('locmem://')
+        cache = ContentObjectCache(backend, models=['tests.Press'])
+        for obj in (self.press1, self.article1):
+            backend.set(cache.key(obj.__class__, obj.pk), {'': obj})
+        self.press1.save()
+        self.article1.save()
+        self.assertEqual(backend.get(cache.key(Press, self.press1.pk)), None)
+        self.assertNotEqual(backend.get(cache.key(Article, self.article1.pk)),
+                            None)
+
+        # Without models only the models it stored are listened for.
+        backend = get_cache('locmem://')
+        cache = ContentObjectCache(backend)
+        backend.set(cache.key(Press, self.press1.pk), {'': self.press1})
+        self.press1.save()
+        self.assertNotEqual(backend.get(cache.key(Press, self.press1.pk)),
+                            None)
+        HomepageItem.objects.filter(slot=self.slot1).get_content_objects(
+            cache=cache, select_related=False)
+        self.press1.save()
+        self.assertEqual(backend.get(cache.key(Press, self.press1.pk)), None)
+
+        cache = ContentObjectCache(backend, models='__all__')
+        backend.set(cache.key(Article, self.article1.pk), {'': self.article1})
+        self.article1.save()
+        self.assertEqual(backend.get(cache.key(Article, self.article1.pk)),
+                         None)
+
+
+class DenormGenericForeignKeyFieldTestCase(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(
+            username='Sean',
+            email='test@test.com',
+        )
+        self.article = Article.objects.create(
+            name='Django 1.2 released!',
+            author=self.author,
+        )
+        self.press = Press.objects.create(
+            name='Django taking the world by storm',
+        )
+        self.slot = Slot.objects.create(
+            name='main',
+        )
+        for i, obj in enumerate((self.article, self.press, self.article)):
+            HomepageItem.objects.create(
+                slot=self.slot,
+                content_type=ContentType.objects.get_for_model(obj),
+                object_id=obj.id,
+                order=i,
+            )
+
+    def test_snapshot(self):
+        items = HomepageItem.objects.all()
+        self.assertEqual([i.content for i in items], [
+            {'name': 'Django 1.2 released!'},
+            {'name': 'Django taking the world by storm'},
+            {'name': 'Django 1.2 released!'},
+        ])
+        self.assertEqual(items[0].content.name, 'Django 1.2 released!')
+
+    def test_related_update(self):
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        self.article.name = 'Django 1.3 released!'
+        self.article.save()
+        # Saving the article and a single update of both items.
+        self.assertEqual(len([q for q in connection.queries
+                              if 'tests_homepageitem' in q['sql']]), 1)
+        settings.DEBUG = _old_debug
+
+        self.press.delete()
+        self.assertEqual([i.content for i in HomepageItem.objects.all()], [
+            {'name': 'Django 1.3 released!'},
+            None,
+            {'name': 'Django 1.3 released!'},
+        ])
+
+    def test_rebuild(self):
+        HomepageItem.objects.update(content=None)
+        self.press.delete()
+        HomepageItem.objects.update(content=None)
+        HomepageItem._meta.get_field('content').update_queryset(
+            HomepageItem.objects.all())
+        self.assertEqual([i.content for i in HomepageItem.objects.all()], [
+            {'name': 'Django 1.2 released!'},
+            None,
+            {'name': 'Django 1.2 released!'},
+        ])
+
+
+class RebuildParallelTestCase(TransactionTestCase):
+    # The worker processes only see committed rows.
+
+    def test_workers(self):
+        if connection.settings_dict['NAME'] in ('', ':memory:'):
+            self.skipTest("Worker processes can't share an in-memory "
+                          "SQLite database.")
+        location = Location.objects.create(name='Chicago')
+        group = Group.objects.create(name='PyChi', location=location)
+        field = Person._meta.get_field("group_list")
+        field.disconnect_signals()
+        try:
+            people = [Person.objects.create(name='Person %d' % i)
+                      for i in range(10)]
+            for person in people:
+                person.groups.add(group)
+        finally:
+            field.connect_signals()
+
+        reports = []
+        report = rebuild_parallel(field, workers=2, chunk_size=2, parts=4,
+            callback=lambda r: reports.append(r.processed))
+        self.assertEqual(report.processed, 10)
+        self.assertEqual(report.chunks, 7)
+        self.assertEqual(report.last_pk, people[-1].pk)
+        self.assertEqual(len(reports), 4)
+        for person in Person.objects.all():
+            self.assertEqual(person.group_list, [{'name': 'PyChi', 'location': {'name': 'Chicago'}}])
+
+
+class FieldAndPksBackend(object):
+    # A queue backend from before the database was passed along.
+
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def enqueue(self, field, pks):
+        if self.fail:
+            raise ValueError('The queue is down.')
+        self.calls.append((field, set(pks)))
+
+
+class ReplicaRouter(object):
+    # Sends reads to the other database, which stands in for a replica
+    # that hasn't caught up.
+
+    def db_for_read(self, model, **hints):
+        return 'other'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+
+class MultipleDatabasesTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.location = Location.objects.using('other').create(name='Chicago')
+        self.group = Group.objects.using('other').create(name='PyChi',
+            location=self.location)
+        self.person = Person.objects.using('other').create(name='Sean')
+
+    def test_using(self):
+        self.person.groups.add(self.group)
+        self.assertEqual(self.person.group_list.pks, [self.group.pk])
+        self.assertEqual(Person.objects.using('other').get(
+            pk=self.person.pk).group_count, 1)
+
+        self.location.name = 'Evanston'
+        self.location.save()
+        self.group.name = 'Djangonauts'
+        self.group.save()
+        person = Person.objects.using('other').get(pk=self.person.pk)
+        self.assertEqual(person.group_list, [
+            {'location': {'name': 'Evanston'}, 'name': 'Djangonauts'},
+        ])
+        self.assertEqual(Location.objects.using('other').get(
+            pk=self.location.pk).group_names, [{'name': 'Djangonauts'}])
+        self.assertEqual(Group.objects.using('other').get(
+            pk=self.group.pk).location_data.name, 'Evanston')
+
+        with filch.bulk():
+            self.group.delete()
+        person = Person.objects.using('other').get(pk=self.person.pk)
+        self.assertEqual((person.group_list, person.group_count), ([], 0))
+        # Nothing was read from or written to the default database.
+        self.assertEqual(Person.objects.using('default').count(), 0)
+
+    def test_stats(self):
+        self.person.groups.add(self.group)
+        collector = stats.MemoryCollector()
+        stats.add_collector(collector)
+        _old_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            connections['other'].queries = []
+            self.group.name = 'Djangonauts'
+            self.group.save()
+            other_queries = len(connections['other'].queries)
+        finally:
+            settings.DEBUG = _old_debug
+            stats.remove_collector(collector)
+
+        # The queries ran on the other database are counted.
+        totals = collector.get('update', 'tests.Person', 'group_list')
+        self.assertEqual(totals['owners'], 1)
+        self.assertTrue(0 < totals['queries'] < other_queries)
+
+    def test_read_from_primary(self):
+        # The replica still has the groups the person on the primary
+        # has left.
+        self.person.groups.add(self.group)
+        Person.objects.using('default').create(pk=self.person.pk, name='Sean')
+        field = Person._meta.get_field('group_list')
+        queryset = Person.objects.filter(pk=self.person.pk)
+
+        _old_routers = router.routers
+        router.routers = [ReplicaRouter()]
+        try:
+            self.assertEqual(field.update_queryset(queryset)[self.person.pk],
+                             field.encode([{'name': 'PyChi',
+                                 'location': {'name': 'Chicago'}}],
+                                 [self.group.pk]))
+            settings.FILCH_READ_FROM_PRIMARY = True
+            self.assertEqual(field.update_queryset(queryset),
+                             {self.person.pk: field.encode([], [])})
+        finally:
+            router.routers = _old_routers
+            settings.FILCH_READ_FROM_PRIMARY = False
+
+    def test_get_content_objects(self):
+        # Content types are numbered differently on the other database.
+        ContentType.objects.db_manager('other').get_for_model(Article)
+        content_type = ContentType.objects.db_manager('other').get_for_model(
+            Press)
+        self.assertNotEqual(content_type.pk,
+                            ContentType.objects.get_for_model(Press).pk)
+        press = Press.objects.using('other').create(name='Django 1.2')
+        HomepageItem.objects.using('other').create(
+            slot_id=Slot.objects.using('other').create(name='main').pk,
+            content_type_id=content_type.pk, object_id=press.pk, order=0)
+        self.assertEqual(HomepageItem.objects.using('other')
+            .get_content_objects(), [press])
+
+        press.name = 'Django 1.3'
+        press.save()
+        self.assertEqual(HomepageItem.objects.using('other')[0].content.name,
+                         'Django 1.3')
+        ContentType.objects.clear_cache()
+
+    def test_get_content_objects_cache(self):
+        # The same pk on both databases is cached separately.
+        for using in ('default', 'other'):
+            press = Press.objects.using(using).create(pk=1,
+                name='Press on %s' % using)
+            HomepageItem.objects.using(using).create(
+                slot_id=Slot.objects.using(using).create(name='main').pk,
+                content_type_id=ContentType.objects.db_manager(
+                    using).get_for_model(Press).pk,
+                object_id=press.pk, order=0)
+        cache = ContentObjectCache(get_cache('locmem://'), models=[Press])
+        for using in ('default', 'other', 'default', 'other'):
+            self.assertEqual([obj.name for obj in HomepageItem.objects \
+                .using(using).get_content_objects(cache=cache)],
+                ['Press on %s' % using])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # Saves only drop the key on their own database.
+        press = Press.objects.using('other').get(pk=1)
+        press.name = 'Press on other, renamed'
+        press.save()
+        self.assertEqual([obj.name for obj in HomepageItem.objects \
+            .using('other').get_content_objects(cache=cache)],
+            ['Press on other, renamed'])
+        self.assertEqual([obj.name for obj in HomepageItem.objects \
+            .using('default').get_content_objects(cache=cache)],
+            ['Press on default'])
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+        ContentType.objects.clear_cache()
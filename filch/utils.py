@@ -1,4 +1,5 @@
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from decimal import Decimal
 
@@ -16,8 +17,11 @@ class JSONEncoder(simplejson.JSONEncoder):
         return super(JSONEncoder, self).default(self, obj)
 
 
+_encoder = JSONEncoder()
+
+
 def dumps(value):
-    return JSONEncoder().encode(value)
+    return _encoder.encode(value)
 
 
 def loads(s):
@@ -26,6 +30,162 @@ def loads(s):
     return value
 
 
+class DenormList(list):
+    """List of denormalized items. pks holds the pk of the related
+    object each item was built from, or None for values that were
+    stored without them.
+    """
+
+    def __init__(self, items=(), pks=None):
+        super(DenormList, self).__init__(items)
+        self.pks = pks
+
+
+class LazyDenormList(DenormList):
+    """A DenormList that is only filled in once its items are needed.
+    Checking whether the list is empty doesn't decode the value,
+    anything else decodes it once into the list itself.
+    """
+
+    def __init__(self, value, decode, empty_values=()):
+        super(LazyDenormList, self).__init__()
+        self.value = value
+        self._decode = decode
+        self._empty_values = empty_values
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        try:
+            items = self._decode(self.value)
+        except ValueError:
+            raise ValueError("You can only pass in a python list " \
+                "or json formated array. You passed in %s" % self.value)
+        self._loaded = True
+        list.extend(self, items)
+        self._pks = items.pks
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def items(self):
+        self._load()
+        return self
+
+    def _get_pks(self):
+        self._load()
+        return self._pks
+
+    def _set_pks(self, pks):
+        # Set by DenormList.__init__ before there is anything to load.
+        self._pks = pks
+
+    pks = property(_get_pks, _set_pks)
+
+    def __nonzero__(self):
+        if not self._loaded and self.value in self._empty_values:
+            return False
+        self._load()
+        return list.__len__(self) > 0
+    __bool__ = __nonzero__
+
+    __hash__ = None
+
+    def __radd__(self, other):
+        self._load()
+        return other + list(self)
+
+    def __reduce__(self):
+        self._load()
+        return (DenormList, (list(self), self._pks))
+
+
+def _loading(name):
+    # Wraps the list method name to fill in the lists it works on
+    # first.
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        for obj in (self,) + args:
+            if isinstance(obj, LazyDenormList):
+                obj._load()
+        return method(self, *args)
+    wrapper.__name__ = name
+    return wrapper
+
+for name in ('__iter__', '__reversed__', '__len__', '__contains__',
+             '__getitem__', '__setitem__', '__delitem__', '__getslice__',
+             '__setslice__', '__delslice__', '__add__', '__iadd__',
+             '__mul__', '__rmul__', '__imul__', '__eq__', '__ne__', '__lt__',
+             '__le__', '__gt__', '__ge__', '__repr__', 'append', 'extend',
+             'insert', 'remove', 'pop', 'index', 'count', 'sort', 'reverse'):
+    if hasattr(list, name):
+        setattr(LazyDenormList, name, _loading(name))
+del name
+
+
+class LRUCache(object):
+    """A thread safe dict that only keeps the size most recently
+    used keys.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_decode_cache = None
+
+
+def get_decode_cache():
+    """Returns the process wide cache of decoded values, or None when
+    the FILCH_DECODE_CACHE_SIZE setting isn't set.
+    """
+    global _decode_cache
+    if _decode_cache is None:
+        size = getattr(settings, 'FILCH_DECODE_CACHE_SIZE', 0)
+        if not size:
+            return None
+        _decode_cache = LRUCache(size)
+    return _decode_cache
+
+
 class DotDict(dict):
 
     __setattr__ = dict.__setitem__
@@ -53,3 +213,10 @@ def convert_lookup_to_dict(key, value):
         else:
             v = {bit: v}
     return (k, DotDict(v))
+
+
+def chunked(items, size):
+    # Yields successive lists of at most size items.
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
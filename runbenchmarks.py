@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import sys
+
+from optparse import OptionParser
+from os.path import dirname, abspath
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=True,
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.sessions',
+            'django.contrib.contenttypes',
+            'filch',
+            'filch.tests',
+        ]
+    )
+
+from django.test.simple import DjangoTestSuiteRunner
+from django.utils import simplejson
+
+
+def runbenchmarks(*args):
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--owners', type='int', default=100,
+        help='Number of people to create.')
+    parser.add_option('--related', type='int', default=5,
+        help='Number of groups each person is in.')
+    parser.add_option('--fanout', type='int', default=10,
+        help='Number of people in each group.')
+    parser.add_option('--repeat', type='int', default=10,
+        help='Number of times each operation is run.')
+    parser.add_option('--output', default=None,
+        help='File to write the results to, one JSON object per line.')
+    options, names = parser.parse_args(list(args))
+
+    parent = dirname(abspath(__file__))
+    sys.path.insert(0, parent)
+    runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+    old_config = runner.setup_databases()
+    try:
+        from filch.tests.benchmarks import run
+        results = run(names, owners=options.owners, related=options.related,
+            fanout=options.fanout, repeat=options.repeat)
+    finally:
+        runner.teardown_databases(old_config)
+
+    output = options.output and open(options.output, 'w') or sys.stdout
+    for result in results:
+        output.write(simplejson.dumps(result, sort_keys=True) + '\n')
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == '__main__':
+    runbenchmarks(*sys.argv[1:])
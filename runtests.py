@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 import sys
 
-from os.path import dirname, abspath
+from os.path import dirname, abspath, join
+from tempfile import gettempdir
 
 from django.conf import settings
 
 if not settings.configured:
     settings.configure(
-        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+        DATABASES={
+            # A file, so the processes rebuild_parallel starts can
+            # read what the tests write.
+            'default': {'ENGINE': 'django.db.backends.sqlite3',
+                'TEST_NAME': join(gettempdir(), 'filch_tests.db')},
+            'other': {'ENGINE': 'django.db.backends.sqlite3'},
+        },
         INSTALLED_APPS=[
             'django.contrib.auth',
             'django.contrib.sessions',